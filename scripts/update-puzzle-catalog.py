@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+"""Regenerate the puzzle catalog after adding, removing or editing puzzles.
+
+The catalog lets the app list puzzles without reading every puzzle file.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from network_puzzles import puzzle  # noqa: E402
+
+
+def main():
+    puzzle.write_catalog()
+    print(f"Wrote {puzzle.CATALOG_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,8 @@
+from functools import cache
+
+from . import session
+
+
 class ItemBase:
     """Base class for all puzzle items that provides access to item's JSON data."""
 
@@ -11,6 +16,36 @@ class ItemBase:
         else:
             self.json = {}
 
+    @classmethod
+    def shared(cls, json_data):
+        """Return the loaded puzzle's wrapper for the JSON data, making it if needed.
+        Anything the wrapper works out for itself is then kept between uses.
+        Args: json_data: dict - the item's JSON data
+        """
+        if session.puzzle is None or not isinstance(json_data, dict):
+            return cls(json_data)
+        return session.puzzle.wrapper(cls, json_data)
+
+
+@cache
+def json_bool(value, default=False) -> bool:
+    """Return the boolean a JSON flag such as "True" or "yes" stands for.
+    Puzzle files keep flags as strings, so each distinct string is only parsed once.
+    Args: value: str - the stored flag, or None if it is missing
+          default: bool - returned when the flag is missing
+    """
+    if value is None:
+        return default
+    return str(value).lower() in ("true", "yes")
+
+
+@cache
+def json_location(value) -> tuple:
+    """Return the integer coordinates from an "x,y" location string.
+    Args: value: str - the stored location
+    """
+    return tuple(int(c) for c in value.split(","))
+
 
 def get_coordinate_distance(sx, sy, dx, dy):
     # The ** is the exponent.  **2 is squared, **.5 is the square-root
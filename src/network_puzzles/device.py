@@ -1,10 +1,24 @@
 import ipaddress
 import logging
+from collections import Counter
 from copy import deepcopy
 
 from . import packet, session
-from .core import ItemBase, conform_json_values, get_puzzle_distance
-from .interface import BROADCAST_IP4, BROADCAST_MAC, GENERIC_IP4, Interface
+from .core import (
+    ItemBase,
+    conform_json_values,
+    get_puzzle_distance,
+    json_bool,
+    json_location,
+)
+from .interface import (
+    BROADCAST_IP4,
+    BROADCAST_MAC,
+    GENERIC_IP4,
+    Interface,
+    ipv4_int,
+    ipv4_network,
+)
 from .link import Link
 from .nic import Nic
 from .route import Route
@@ -42,14 +56,7 @@ class Device(ItemBase):
 
     @property
     def blown_up(self) -> bool:
-        value = False
-        if "blownup" in self.json:
-            if self.json.get("blownup", "").lower() in ("true", "yes"):
-                value = True
-            else:
-                value = False
-            # logging.debug(f"{self.hostname}.powered_on: {value}")
-        return value
+        return json_bool(self.json.get("blownup"))
 
     @blown_up.setter
     def blown_up(self, value):
@@ -138,6 +145,12 @@ class Device(ItemBase):
                 "type": "gw",
             }
         self.json["gateway"]["ip"] = ip
+        session.puzzle.invalidate("fib")
+
+    @property
+    def forwarding_table(self):
+        """The device's routes, compiled for quick lookups."""
+        return session.puzzle.forwarding_table(self)
 
     @property
     def hostname(self) -> str:
@@ -146,6 +159,9 @@ class Device(ItemBase):
     @hostname.setter
     def hostname(self, name):
         self.json["hostname"] = name
+        if session.puzzle:
+            session.puzzle.invalidate("device", "arp")
+            session.puzzle.mark_wireless_dirty()
 
     @property
     def ip_connections(self):
@@ -162,12 +178,7 @@ class Device(ItemBase):
 
     @property
     def is_dhcp(self) -> bool:
-        if self.json.get("isdhcp", "").lower() in ("true", "yes"):
-            value = True
-        else:
-            value = False
-        # logging.debug(f"{self.hostname}.is_dhcp {value=}")
-        return value
+        return json_bool(self.json.get("isdhcp"))
 
     @is_dhcp.setter
     def is_dhcp(self, value):
@@ -178,11 +189,7 @@ class Device(ItemBase):
     @property
     def is_firewall(self) -> bool:
         """Returns `True` if firewall is activated, `False` if not."""
-        if self.json.get("hasadvfirewall", "").lower() in ("true", "yes"):
-            value = True
-        else:
-            value = False
-        return value
+        return json_bool(self.json.get("hasadvfirewall"))
 
     @is_firewall.setter
     def is_firewall(self, value):
@@ -192,13 +199,7 @@ class Device(ItemBase):
 
     @property
     def is_invisible(self) -> bool:
-        if self.json.get("isinvisible", "").lower() in ("true", "yes"):
-            # The device is hidden.
-            value = True
-        else:
-            value = False
-        # logging.debug(f"{self.hostname}.is_invisible: {value} ")
-        return value
+        return json_bool(self.json.get("isinvisible"))
 
     @is_invisible.setter
     def is_invisible(self, value):
@@ -220,7 +221,7 @@ class Device(ItemBase):
     def location(self) -> tuple:
         loc = self.json.get("location")
         if loc:
-            return tuple((int(c) for c in loc.split(",")))
+            return json_location(loc)
         raise ValueError(f"Invalid JSON location data for '{self.hostname}'")
 
     @property
@@ -235,22 +236,20 @@ class Device(ItemBase):
     @property
     def nics(self):
         """Returns NIC objects."""
-        return [Nic(d) for d in self.nics_data]
+        return [Nic.shared(d) for d in self.nics_data]
 
     @property
     def powered_on(self) -> bool:
-        if self.json.get("poweroff", "").lower() in ("true", "yes"):
-            value = False
-        else:
-            value = True
-        # logging.debug(f"{self.hostname}.powered_on: {value}")
-        return value
+        return not json_bool(self.json.get("poweroff"))
 
     @powered_on.setter
     def powered_on(self, value):
         if isinstance(value, bool):
             value = str(value)
         self.json["poweroff"] = value
+        if session.puzzle:
+            session.puzzle.invalidate("domains")
+            session.puzzle.mark_wireless_dirty(self.hostname)
 
     @property
     def port_arps(self):
@@ -288,11 +287,7 @@ class Device(ItemBase):
             Nic(onenic).uses_dhcp = False
 
     def all_tests(self):
-        tests = []
-        for t in session.puzzle.all_tests():
-            if t.get("shost") == self.hostname:
-                tests.append(t)
-        return tests
+        return session.puzzle.all_tests(self.hostname)
 
     def get_nics_local_to(self, ip_address):
         logging.debug(f"Dev: {ip_address=}")
@@ -353,9 +348,8 @@ class Device(ItemBase):
             if nic.name == "lo0":
                 continue
             for iface in nic.interfaces:
-                try:
-                    ip = ipaddress.ip_interface(iface.ipaddress)
-                except ValueError:
+                ip = iface.ipaddress
+                if ip is None:
                     # If the IP is invalid, do not add it
                     continue
                 mac = {
@@ -375,59 +369,12 @@ class Device(ItemBase):
 
         # A route must contain 'nic' and 'interface', and may contain 'gateway'.
         new_route = Route()
-
-        # Set gateway if dest IP is in device routes.
-        # logging.debug(f"Checking for static route: {theDeviceRec["route"]}")
-        destinationIP = ipaddress.ip_address(packet.justIP(dest_ip))
-        for route_data in self.routes:
-            route = Route(route_data)
-            staticroute = ipaddress.ip_network(route.network, strict=False)
-            logging.debug(
-                f"Checking if destinationIp {dest_ip} is in staticroute {staticroute} from {route.network}"
-            )
-            if destinationIP in staticroute:
-                # We found a gateway that we should use.
-                logging.debug(f"Found a static route.  Adding gateway: {route.gateway}")
-                new_route.gateway = route.gateway
-                break
-
-        # if not a device route, look through device nics
-        if not new_route.gateway:
-            # We did not find it in the static routes.  Loop through all nics and see if one is local
-            logging.debug("No gateway set in routerec.  Looking through nics")
-            for nic in self.nics:
-                skipzeroes = True
-                if dest_ip == "255.255.255.255":
-                    skipzeroes = False
-                localInterface = nic.find_local_interface(dest_ip, skipzeroes)
-                if localInterface is not None:
-                    # We found it.  Use it.
-                    logging.debug(
-                        f" Adding nic and interface to routeRec: {localInterface}"
-                    )
-                    new_route.interface = localInterface
-                    break
-
-        # if not a device nic, use the default gateway
-        if not new_route.interface and not new_route.gateway:
-            # use the device default gateway
-            logging.debug(f"Still no idea. Using default gateway: {self.gateway}")
-            new_route.gateway = self.gateway
-
-        # if we have a gateway but do not know the nic and interface, find the right one
+        # Static routes first, then local nics, then the default gateway.
+        new_route.gateway, new_route.interface = self.forwarding_table.lookup(dest_ip)
         if new_route.gateway and not new_route.interface:
-            logging.debug(f"Finding nic to use for routerec: {new_route}")
-            for nic in self.nics:
-                localInterface = nic.find_local_interface(new_route.gateway, True)
-                if localInterface is not None:
-                    # We found it.  Use it.
-                    new_route.interface = localInterface
-                    break
-
-            if not new_route.interface:
-                logging.warning(
-                    f"Device: interface not found for gateway: {new_route.gateway}"
-                )
+            logging.warning(
+                f"Device: interface not found for gateway: {new_route.gateway}"
+            )
 
         # We should now have a good routeRec.  gateway might be blank, if it is local
         # But we should have an interface set.
@@ -438,6 +385,73 @@ class Device(ItemBase):
         session.print(f"No interface found for device: {self.hostname}")
         return None
 
+    def route_out(self, dest_ip):
+        """Find the way a packet leaves this device for a destination.
+        Args: dest_ip: the packet's destination IP address
+        returns: a tuple of (route, interface.Interface, nic.Nic) for the route, or
+            None if there is no route
+        """
+        route = self.get_route_for_dest_ip(dest_ip)
+        if route is None:
+            return None
+        route_interface = Interface.shared(route.interface)
+        route_nic = Nic.shared(self.nic_from_name(route_interface.nicname))
+        return route, route_interface, route_nic
+
+    def address_for_route(self, pkt, route, route_nic):
+        """Set a packet's source MAC and next-hop MAC for the route it leaves on.
+        Args:
+            pkt: packet.Packet - the packet leaving the device
+            route: Route - the route it leaves on, see route_out()
+            route_nic: nic.Nic - the network card the route goes out of
+        """
+        pkt.source_mac = route_nic.mac
+        pkt.json["tdestIP"] = route.gateway  # track when we use a gateway
+        # Broadcasts keep their MAC, and DHCP answers go to the asking card's MAC.
+        if pkt.destination_mac == BROADCAST_MAC or pkt.packettype == "dhcp-response":
+            return
+        if route.gateway is not None:
+            # We are going out the gateway.  Find the ARP for that
+            pkt.destination_mac = globalArpLookup(route.gateway)
+        else:
+            # We are on a local link.  Set the destmac to be the mac of our destination computer
+            pkt.destination_mac = globalArpLookup(pkt.destination_ip)
+        logging.debug(
+            f"Using dest mac {pkt.destination_mac} for {str(pkt)} at {self.hostname}"
+        )
+
+    def flood_ports(self, pkt, inbound_nic=None):
+        """List the ports a hub or switch copies a packet out of.
+        A switch that has learned which port the destination MAC is on only uses that one.
+        Args:
+            pkt: packet.Packet - the packet being copied
+            inbound_nic: nic.Nic - the network card it came in on, which is skipped
+        returns: a list of (nic.Nic, link json) for each connected port
+        """
+        onlyport = ""
+        if self.mytype == "net_switch":
+            # we just send this out the one port.
+            onlyport = self.json.get("port_arps", {}).get(pkt.destination_mac, "")
+        ports = []
+        for device_nic in self.nics:
+            if (
+                inbound_nic
+                and inbound_nic.uniqueidentifier == device_nic.uniqueidentifier
+            ):
+                logging.debug(f"skipping port we came in on: {inbound_nic.name}")
+                continue
+            if device_nic.type not in ("port", "wport") and self.mytype not in (
+                "wap",
+                "wbridge",
+                "wrepeater",
+            ):
+                # we do not send packets out eth, vpn, etc.  We do send it out wap and wbridge eth ports
+                continue
+            connected_link = device_nic.get_connected_link()
+            if connected_link is not None and onlyport in ("", device_nic.name):
+                ports.append((device_nic, connected_link))
+        return ports
+
     def nic_from_name(self, nicname):
         """return the network card from the name
         Args:
@@ -541,6 +555,7 @@ class Device(ItemBase):
         )
 
         self.routes.append(route.json)
+        session.puzzle.invalidate("fib")
         return True
 
     def route_del(self, target, gateway):
@@ -562,6 +577,7 @@ class Device(ItemBase):
             ):
                 logging.debug("  Deleting the route.")
                 self.routes.remove(route.json)
+                session.puzzle.invalidate("fib")
                 return
         # If we get here, nothing yet matched.  Could not find it.  Nothing to drop
         session.print("No such route")
@@ -588,15 +604,23 @@ class Device(ItemBase):
                     f"{t_nic.name} ssid: {t_nic.ssid} key: {t_nic.encryption_key}"
                 )
 
+        if any(Nic(onenic).type == "wan" for onenic in self.nics_data):
+            table = self.connection_table
+            session.print(
+                f"connections: {len(table.records)} open, {table.matched} matched, "
+                f"{table.unmatched} unmatched, {table.evicted} dropped"
+            )
+
         # logging.debug(f" showing device routes {len(thedevice.get("route"))} {thedevice.get("route")}")
         for route in self.routes:
             session.print(f"route: {Route(route)}")
 
         if len(self.firewall_rules) > 0:
             session.print("Firewall Rules:")
+            firewall = self.firewall
             for onerule in self.firewall_rules:
                 session.print(
-                    f"  {onerule.get('source')} - {onerule.get('destination')} -> {onerule.get('action')}"
+                    f"  {onerule.get('source')} - {onerule.get('destination')} -> {onerule.get('action')} ({firewall.rule_hits(onerule)} hits)"
                 )
 
     # firewall pieces
@@ -691,7 +715,7 @@ class Device(ItemBase):
                     dst_hostname = dev_nic_link.src
                 else:
                     dst_hostname = dev_nic_link.dest
-                dst_dev = Device(session.puzzle.device_from_name(dst_hostname))
+                dst_dev = Device.shared(session.puzzle.device_from_name(dst_hostname))
 
                 # Set destroy status.
                 destroy_link = False
@@ -756,47 +780,42 @@ class Device(ItemBase):
                 current_distance = 500
 
                 if dev_nic_link is not None:
-                    dst_dev = Device(session.puzzle.device_from_name(dst_hostname))
+                    dst_dev = Device.shared(
+                        session.puzzle.device_from_name(dst_hostname)
+                    )
                     sx, sy = self.location
                     dx, dy = dst_dev.location
                     current_distance = get_puzzle_distance(sx, sy, dx, dy)
 
-                for onedevice in session.puzzle.all_devices():
-                    t_onedevice = Device(onedevice)
-                    if (
-                        t_onedevice.is_wireless_forwarder
-                        and t_onedevice.hostname != self.hostname
-                    ):
+                for onedevice, dstnics in session.puzzle.wireless_access_points_near(
+                    self, dev_nic
+                ):
+                    t_onedevice = Device.shared(onedevice)
+                    if t_onedevice.hostname != self.hostname:
                         # logging.debug(f"Can we connect it to: {t_onedevice.hostname}")
-                        # Check to see if ssid and key match.  And if so, does it have an empty port to connect to?
-                        for dstnic in t_onedevice.nics_data:
-                            t_dstnic = Nic(dstnic)
-                            # logging.debug(f"Checking out {t_dstnic.type} {t_dstnic.encryption_key} {t_dstnic.ssid}" )
-                            if (
-                                t_dstnic.type == "wport"
-                                and t_dstnic.encryption_key == dev_nic.encryption_key
-                                and t_dstnic.ssid == dev_nic.ssid
-                            ):
-                                if t_dstnic.get_connected_link() is None:
-                                    # the key and ssid match, and the port is available.  Track the distance.
-                                    sx, sy = self.location
-                                    dx, dy = t_onedevice.location
-                                    t_dst_distance = get_puzzle_distance(sx, sy, dx, dy)
-                                    if (
-                                        closest_distance is None
-                                        or t_dst_distance <= closest_distance
-                                    ):
-                                        closest_distance = t_dst_distance
-                                        closest_dev = t_onedevice
-                                        closest_nic = t_dstnic
-                                        logging.debug(
-                                            f"{t_onedevice.hostname} {t_dstnic.name} {t_dst_distance:.2f} is closer to {self.hostname}"
-                                        )
-                                        break  # we found one, break out of the for loop
-                                else:
+                        # The ssid and key match.  Does it have an empty port to connect to?
+                        for dstnic in dstnics:
+                            t_dstnic = Nic.shared(dstnic)
+                            if t_dstnic.get_connected_link() is None:
+                                # the key and ssid match, and the port is available.  Track the distance.
+                                sx, sy = self.location
+                                dx, dy = t_onedevice.location
+                                t_dst_distance = get_puzzle_distance(sx, sy, dx, dy)
+                                if (
+                                    closest_distance is None
+                                    or t_dst_distance <= closest_distance
+                                ):
+                                    closest_distance = t_dst_distance
+                                    closest_dev = t_onedevice
+                                    closest_nic = t_dstnic
                                     logging.debug(
-                                        f"{t_onedevice.hostname} {t_dstnic.name} already has a link"
+                                        f"{t_onedevice.hostname} {t_dstnic.name} {t_dst_distance:.2f} is closer to {self.hostname}"
                                     )
+                                    break  # we found one, break out of the for loop
+                            else:
+                                logging.debug(
+                                    f"{t_onedevice.hostname} {t_dstnic.name} already has a link"
+                                )
 
                 # We now have closest_dev being the closest device that is a possibility.  If it is close enough, make a link.
                 logging.debug(
@@ -837,19 +856,25 @@ class Device(ItemBase):
     def AdvFirewallAllows(self, InInterface: str, OutInterface: str):
         if not self.HasAdvancedFirewall:
             return True  # We can go out the firewall if no rules
-        # logging.debug("Testing firewall rule. in {InInterface} - out {OutInterface}")
-        for onerule in self.firewall_rules:
-            if (
-                onerule.get("source") == InInterface
-                and onerule.get("destination") == OutInterface
-            ):
-                # logging.debug("Found match.")
-                if onerule.get("action") == "Drop" or onerule.get("action") == "drop":
-                    return False
-                if onerule.get("action") == "Allow" or onerule.get("action") == "allow":
-                    return True
-        # If no rules prohibit it, allow it.  Default policy
-        return True
+        firewall = self.firewall
+        allowed = firewall.verdict(InInterface, OutInterface)
+        if allowed is None:
+            # If no rules prohibit it, allow it.  Default policy
+            return True
+        firewall.record_hit(InInterface, OutInterface)
+        return allowed
+
+    @property
+    def firewall(self):
+        """The `FirewallRules` compiled from this device's firewall rules."""
+        if session.puzzle is None:
+            return FirewallRules(self.firewall_rules)
+        return session.puzzle.firewall(self)
+
+    def firewall_changed(self):
+        """Recompile the firewall rules when next used; call after editing them in place."""
+        if session.puzzle is not None:
+            session.puzzle.invalidate("firewall")
 
     def AdvFirewallAdd(self, InInterface: str, OutInterface: str, dropallow: str):
         logging.debug(
@@ -863,6 +888,7 @@ class Device(ItemBase):
                 and onerule.get("destination") == OutInterface
             ):
                 onerule["action"] = dropallow.lower()
+                self.firewall_changed()
                 return True
         # If we get here, nothing yet matched.  Add a new record
         newfw = {
@@ -871,6 +897,7 @@ class Device(ItemBase):
             "action": dropallow,
         }
         self.json["firewallrule"].append(newfw)
+        self.firewall_changed()
         return True
 
     def AdvFirewallDel(self, InInterface: str, OutInterface: str, dropallow: str):
@@ -886,28 +913,23 @@ class Device(ItemBase):
                 and onerule.get("action").lower() == dropallow.lower()
             ):
                 self.json["firewallrule"].remove(onerule)
+                self.firewall_changed()
                 return True
         # If we get here, nothing yet matched.  Add a new record
         return False
 
     # NAT-table functions
     # for tracking outbound packets on WAN network cards.
-    def AddIPConnectionEntry(self, dest_ip, src_ip, packettype, response):
+    def AddIPConnectionEntry(self, dest_ip, src_ip, packettype, response, masq_ip=None):
         """Add a record of the packet and what we should do when we encounter its response
         dest_ip: the IP address of the destination
         src_ip: the IP address of the source
         packettype: 'ping, ping-response, etc.
-        response: One of  none|accept|masq|drop|reject"""
-
-        newrec = {
-            "dest": packet.justIP(dest_ip),
-            "src": packet.justIP(src_ip),
-            "packettype": packettype.lower(),
-            "response": response.lower(),
-            "masqsrc": packet.justIP(src_ip),
-        }
-        self.ip_connections.append(newrec)
-        return newrec
+        response: One of  none|accept|masq|drop|reject
+        masq_ip: the IP address the packet is masqueraded as, if any"""
+        return self.connection_table.add(
+            dest_ip, src_ip, packettype, response, self._sim_time(), masq_ip
+        )
 
     def ReturnIPConnectionEntry(self, dest_ip, src_ip, packettype):
         """Look up and return the IP packet matching info, if it exists
@@ -915,41 +937,84 @@ class Device(ItemBase):
         src_ip: the IP address of the source
         packettype: 'ping, ping-response, etc.
         response: One of  none|accept|masq|drop|reject"""
+        return self.connection_table.consume(
+            dest_ip, src_ip, packettype, self._sim_time()
+        )
 
-        check_type = packettype
-        if packettype == "ping-response":
-            check_type = "ping"
-        if packettype == "traceroute-request":
-            check_type = "traceroute-response"
-
-        for onerec in self.ip_connections[:]:
-            logging.debug(
-                f"checking for response {packet.justIP(dest_ip)}, {packet.justIP(src_ip)} {packettype} check_type: {check_type}"
+    def track_outbound(self, pkt, route_interface, route_nic, table=None):
+        """Record a packet leaving the device so its response is let back in,
+        masquerading it if it leaves by a WAN port and did not start here.
+        Args:
+            pkt: packet.Packet - the packet leaving the device
+            route_interface: interface.Interface - the interface it leaves from
+            route_nic: nic.Nic - the network card it leaves from
+            table: ConnectionTable - where to record it; defaults to this device's
+        """
+        if table is None:
+            table = self.connection_table
+        # valid responses are: masq, accept, drop, reject, none
+        if route_nic.type == "wan" and not pkt.justcreated:
+            logging.debug("We are masquerading the packet")
+            table.add(
+                pkt.destination_ip,
+                pkt.source_ip,
+                pkt.packettype,
+                "masq",
+                self._sim_time(),
+                route_interface.ip,
             )
-            logging.debug(
-                f"checking for response {onerec['dest']}, {onerec['src']} {onerec['packettype']}"
+            pkt.source_ip = route_interface.ip
+        else:
+            logging.debug(f"We are tracking outbound packet on {route_nic.type}")
+            table.add(
+                pkt.destination_ip,
+                pkt.source_ip,
+                pkt.packettype,
+                "accept",
+                self._sim_time(),
             )
-            if (
-                onerec["dest"] == packet.justIP(dest_ip)
-                and onerec["src"] == packet.justIP(src_ip)
-                and onerec["packettype"] == packettype
-            ):
-                # outbound packet
-                continue
-            if (
-                onerec["src"] == packet.justIP(dest_ip)
-                and onerec["dest"] == packet.justIP(src_ip)
-                and onerec["packettype"] == check_type
-            ):
-                logging.debug("found one!")
-                # Connection has been consumed. Remove it now.
-                self.ip_connections.remove(onerec)
-                return onerec
 
-        return None
+    def admit_from_wan(self, pkt, table=None) -> bool:
+        """Check a packet coming in a WAN port, undoing any masquerading.
+        Only answers to packets that went out, and packets for this device, get in.
+        Args:
+            pkt: packet.Packet - the packet coming in
+            table: ConnectionTable - the outbound records; defaults to this device's
+        returns: True if the packet is let in
+        """
+        if table is None:
+            table = self.connection_table
+        connection_info = table.consume(
+            pkt.destination_ip, pkt.source_ip, pkt.packettype, self._sim_time()
+        )
+        if connection_info is not None:
+            logging.debug(f"Found a return packet: {connection_info}")
+            if connection_info["response"] == "masq":
+                logging.debug(
+                    f"Packet was masqueraded.  Switching it back {connection_info['src']} -> {connection_info['masqsrc']}"
+                )
+                pkt.destination_ip = connection_info["masqsrc"]
+            return True
+        # we do not have a record of this.  Packets coming into the WAN, unless it is destined for here, are dropped.
+        if self.nic_from_ip(pkt.destination_ip) is None:
+            logging.debug(
+                "No record of this and not destined for this machine.  Drop it for now"
+            )
+            return False
+        return True
 
     def ClearIPConnections(self):
-        self.ip_connections = []
+        self.connection_table.clear()
+
+    @property
+    def connection_table(self):
+        """The `ConnectionTable` that indexes this device's NAT records."""
+        if session.puzzle is None:
+            return ConnectionTable(self.ip_connections)
+        return session.puzzle.connection_table(self)
+
+    def _sim_time(self):
+        return session.puzzle.sim_time if session.puzzle else 0
 
     def begin_ingress_on_nic(self, nic, pkt):
         """Begin the packet entering a device.  It enters via a nic, and then is processed.
@@ -1005,27 +1070,9 @@ class Device(ItemBase):
         # If we are entering a WAN port, see if we should be blocked or if it is a return packet
         if nic.type == "vpn":
             logging.debug(f"Coming in a VPN link: {pkt.json}")
-        if nic.type == "wan":
-            connection_info = self.ReturnIPConnectionEntry(
-                pkt.destination_ip, pkt.source_ip, pkt.packettype
-            )
-            if connection_info is not None:
-                logging.debug(f"Found a return packet: {connection_info}")
-                if connection_info["response"] == "masq":
-                    logging.debug(
-                        f"Packet was masqueraded.  Switching it back {connection_info['src']} -> {connection_info['masqsrc']}"
-                    )
-                    pkt.destination_ip = connection_info["masqsrc"]
-            else:
-                # we do not have a record of this.  Packets coming into the WAN, unless it is destined for here, are dropped.
-                # see if the packet is destined for us.
-                t_nic = self.nic_from_ip(pkt.destination_ip)
-                if t_nic is None:
-                    logging.debug(
-                        "No record of this and not destined for this machine.  Drop it for now"
-                    )
-                    pkt.status = "done"
-                    return False
+        if nic.type == "wan" and not self.admit_from_wan(pkt):
+            pkt.status = "done"
+            return False
         if pkt.destination_mac is None:
             # The packet was improperly crafted or no such machine exists.  Drop
             logging.debug(
@@ -1034,14 +1081,7 @@ class Device(ItemBase):
             pkt.status = "failed"
             return False
 
-        if (
-            pkt.destination_mac == nic.mac
-            or packet.is_broadcast_mac(pkt.destination_mac)
-            or self.routes_packets
-            or self.is_wireless_forwarder
-            or nic.type == "port"
-            or nic.type == "wport"
-        ):
+        if nic.accepts(pkt, self):
             # The packet is good, and has reached the computer.  Pass it on to the device
             logging.debug("Packet entering device: {self.hostname}")
             return self.receive_packet(pkt, nic)
@@ -1167,7 +1207,8 @@ class Device(ItemBase):
                     )
                     # we need to generate a traceroute response
                     nPacket = self.create_packet(dest, "traceroute-response")
-                    nPacket.payload = pkt.payload
+                    # Payloads are shared between flooded copies; this one gets edited.
+                    nPacket.payload = dict(pkt.payload)
                     self.send_packet(nPacket, inbound_nic)
                     nPacket.payload["tempDest"] = nPacket.source_ip
                     nPacket.add_to_packet_list()
@@ -1463,6 +1504,36 @@ class Device(ItemBase):
                 self.send_packet(nPacket, None, nic.json)
                 nPacket.add_to_packet_list()
 
+    def _free_dhcp_ip(self, inboundip):
+        """Return the first address in the DHCP range served on the given IP that is not leased.
+        Args: inboundip: str - the IP of the interface the request came in on
+        returns: the address as a string, or "" if there is no range or it is full
+        """
+        iprange = None
+        for onerange in self.dhcp_range:
+            if onerange["ip"] == inboundip:
+                iprange = onerange
+        if iprange is None:
+            logging.debug(f"Unable to find a DHCP range in {self.hostname}")
+            return ""
+
+        rangestart = int(
+            iprange["mask"].split(".")[3]
+        )  # they were stored a bit oddly in the original json
+        rangeend = int(
+            iprange["gateway"].split(".")[3]
+        )  # they were stored a bit oddly in the original json
+        # use the starting portion of the range, to allow for broken ranges.
+        iparr = iprange["mask"].split(".")
+        ipprepend = f"{iparr[0]}.{iparr[1]}.{iparr[2]}."
+        leased = set(self.dhcp_list.values())
+        for i in range(rangestart, rangeend):
+            newip = ipprepend + str(i)
+            if newip not in leased:
+                logging.debug(f"New ip address would be {newip}")
+                return newip
+        return ""
+
     def _make_dhcp_response(self, pkt, nic):
         # Ensure Packet object.
         if not isinstance(pkt, packet.Packet):
@@ -1477,41 +1548,11 @@ class Device(ItemBase):
         inbound_interface = tnic.interfaces[0]
         inboundip = inbound_interface.ip_obj.address
         logging.debug(f"making a dhcp response on nic {tnic.name}; {inboundip}")
-        iprange = None
-        available_ip = ""  # start with it empty.  Fill it if we can
-        for onerange in self.dhcp_range:
-            if onerange["ip"] == inboundip:
-                iprange = onerange
-
-        if iprange is not None:
-            rangestart = int(
-                iprange["mask"].split(".")[3]
-            )  # they were stored a bit oddly in the original json
-            rangeend = int(
-                iprange["gateway"].split(".")[3]
-            )  # they were stored a bit oddly in the original json
-            # use the starting portion of the range, to allow for broken ranges.
-            iparr = iprange["mask"].split(".")
-            ipprepend = f"{iparr[0]}.{iparr[1]}.{iparr[2]}."
-            for i in range(rangestart, rangeend):
-                newip = ipprepend + str(i)
-                found = False
-                for dhcpentry in self.dhcp_list.values():
-                    if dhcpentry == newip:
-                        found = True
-                        break
-                if not found:
-                    available_ip = newip
-                    logging.debug(f"New ip address would be {newip}")
-                    break
-        else:
-            logging.debug(f"Unable to find a DHCP range in {self.hostname}")
-        # Now, check to see if we have an entry already.
         if pkt.source_mac in self.dhcp_list:
-            # FIXME: How to remove bad DHCP entry from list and add new one?
             # we already have an entry. Use it
             available_ip = self.dhcp_list.get(pkt.source_mac)
         else:
+            available_ip = self._free_dhcp_ip(inboundip)
             logging.debug(
                 f"DHCP: Making an IP reservation {available_ip} {pkt.source_mac}"
             )
@@ -1556,43 +1597,25 @@ class Device(ItemBase):
         pkt.distance = 0  # always reset this
 
         # determine which interface/nic we are exiting out of - routing
-        route = self.get_route_for_dest_ip(pkt.destination_ip)
-        if route is None:
+        route_out = self.route_out(pkt.destination_ip)
+        if route_out is None:
             msg = f"Unable to determine route from {self.hostname} to IP {pkt.destination_ip}"
             session.print(msg)
             pkt.status = "done"
             return
+        route, route_interface, route_nic = route_out
         logging.debug(f"Found a route rec: {route}")
 
-        # Define route-dependent objects.
-        route_interface = Interface(route.interface)
-        route_nic = Nic(self.nic_from_name(route_interface.nicname))
-
         # Determine outbound link.
         destlink = None
         if nic_out is not None:
             # We have a specific NIC we are sending this out.
-            destlink = Nic(nic_out).get_connected_link()
+            destlink = Nic.shared(nic_out).get_connected_link()
 
         # set the source MAC address on the packet as from the nic
         if destlink is None:
-            pkt.source_mac = route_nic.mac
-            pkt.json["tdestIP"] = route.gateway  # track when we use a gateway
-            # set the destination MAC to be the GW MAC if the destination is not local
-            # this needs an ARP lookup.  That currently is in puzzle, which would make a circular include.
-            if (
-                pkt.destination_mac != BROADCAST_MAC
-                and pkt.packettype != "dhcp-response"
-            ):
-                if route.gateway is not None:
-                    # We are going out the gateway.  Find the ARP for that
-                    pkt.destination_mac = globalArpLookup(route.gateway)
-                else:
-                    # We are on a local link.  Set the destmac to be the mac of our destination computer
-                    pkt.destination_mac = globalArpLookup(pkt.destination_ip)
-                logging.debug(
-                    f"Using dest mac {pkt.destination_mac} for {str(pkt)} at {self.hostname}"
-                )
+            self.address_for_route(pkt, route, route_nic)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
                 for d in session.puzzle.devices:
                     logging.debug(f"{d.get('hostname')=}; {Device(d).mac_list()}")
 
@@ -1622,31 +1645,10 @@ class Device(ItemBase):
             logging.debug("Not using VPN")
 
         if destlink is not None:
-            pkt.packet_location = destlink["hostname"]
-            if destlink["SrcNic"]["hostname"] == self.hostname:
-                pkt.direction = 1  # Src to Dest
-            else:
-                pkt.direction = 2  # Dest to Source
+            pkt.enter_link(destlink, self.hostname)
             # If we get here, we know which interface the packet is going out of.
             # track outbound packets.
-
-            # if we are going out the WAN and did not originate here, masq the packet
-            # In all other cases, accept
-            # valid responses are: masq, accept, drop, reject, none
-            if route_nic.type == "wan" and not pkt.justcreated:
-                connectionrec = self.AddIPConnectionEntry(
-                    pkt.destination_ip, pkt.source_ip, pkt.packettype, "masq"
-                )
-                # here we masquerade the packet
-                logging.debug("We are masquerading the packet")
-                connectionrec["src"] = route_interface.ip
-                pkt.source_ip = route_interface.ip
-
-            else:
-                logging.debug(f"We are tracking outbound packet on {route_nic.type}")
-                self.AddIPConnectionEntry(
-                    pkt.destination_ip, pkt.source_ip, pkt.packettype, "accept"
-                )
+            self.track_outbound(pkt, route_interface, route_nic)
 
             # If we are an originating packet, check firewall.  A reply gets allowed.
             if (
@@ -1687,55 +1689,14 @@ class Device(ItemBase):
 
         # We loop through all nics. (minus the one we came in from), unless
         # destination MAC is already known.
-        onlyport = ""
-        if self.mytype == "net_switch":
-            if pkt.destination_mac in self.json.get("port_arps", {}):
-                # we just send this out the one port.
-                onlyport = self.json.get("port_arps").get(pkt.destination_mac)
-
-        # print("We are forwarding.")
-        for onenic in self.nics_data:
-            device_nic = Nic(onenic)
-            if (
-                inbound_nic
-                and inbound_nic.uniqueidentifier == device_nic.uniqueidentifier
-            ):
-                logging.debug(f"skipping port we came in on: {inbound_nic.name}")
-                continue
-            # we duplicate the packet and send it out each port-type
-            # find the link connected to the port
-            # logging.debug(f"#### device type is {self.mytype} nic {n.type}")
-            if device_nic.type not in ("port", "wport") and self.mytype not in (
-                "wap",
-                "wbridge",
-                "wrepeater",
-            ):
-                # we do not send packets out eth, vpn, etc.  We do send it out wap and wbridge eth ports
-                # logging.debug ("  No.  Not sent out port"
-                # logging.debug("   skipped")
-                continue
-            connected_link = device_nic.get_connected_link()
-            if connected_link is not None and (
-                inbound_nic is None
-                or inbound_nic.uniqueidentifier != device_nic.uniqueidentifier
-            ):
-                logging.debug(
-                    f"Sending packet out port: {device_nic.name} {device_nic.type}"
-                )
-                # We have a network wire connected to the NIC.  Send the packet out
-                # if it is a switch-port, then we check first if we know where the packet goes - undone
-                if onlyport == "" or onlyport == device_nic.name:
-                    tpacket = packet.Packet(deepcopy(pkt.json))
-                    # Update location to outgoing link.
-                    tpacket.packet_location = connected_link.get("hostname")
-                    # Reset distance to the beginning of outgoing link.
-                    tpacket.distance = 0
-                    # Set direction.
-                    if connected_link["SrcNic"]["hostname"] == self.hostname:
-                        tpacket.direction = 1  # Src to Dest
-                    else:
-                        tpacket.direction = 2  # Dest to Source
-                    tpacket.add_to_packet_list()
+        for device_nic, connected_link in self.flood_ports(pkt, inbound_nic):
+            logging.debug(
+                f"Sending packet out port: {device_nic.name} {device_nic.type}"
+            )
+            # We duplicate the packet and send it out each port
+            tpacket = pkt.clone()
+            tpacket.enter_link(connected_link, self.hostname)
+            tpacket.add_to_packet_list()
 
         # The packet that came in gets killed since it was replicated everywhere else.
         # but only if we are a not a router.
@@ -1752,9 +1713,201 @@ class Device(ItemBase):
                 return item
 
 
+# How many connections a device tracks before it forgets the oldest ones.
+MAX_IP_CONNECTIONS = 256
+
+
+class ConnectionTable:
+    """A device's NAT records, indexed so that a reply finds its connection in one lookup.
+
+    The records themselves stay in the device's "IPConnections" list so that they
+    are saved and undone along with the rest of the puzzle; this only indexes them.
+    Connections are forgotten once they are too old to ever get a reply, or when
+    there are too many of them.
+    """
+
+    def __init__(self, records: list, now: float = 0, lifetime: float | None = None):
+        """
+        Args:
+            records: list - the device's connection records, oldest first
+            now: float - the simulation time, used as the age of the existing records
+            lifetime: float - how long a connection waits for its reply; None for no limit
+        """
+        self.records = records
+        self.lifetime = lifetime
+        self._index = {}  # (src, dest, packettype) -> records, oldest first
+        self._added = {}  # id(record) -> simulation time it was added
+        self.matched = 0
+        self.unmatched = 0
+        self.evicted = 0
+        for record in records:
+            self._file(record, now)
+
+    def _file(self, record, now):
+        key = (record["src"], record["dest"], record["packettype"])
+        self._index.setdefault(key, []).append(record)
+        self._added[id(record)] = now
+
+    def _unfile(self, record):
+        key = (record["src"], record["dest"], record["packettype"])
+        bucket = self._index[key]
+        for position, onerec in enumerate(bucket):
+            if onerec is record:
+                del bucket[position]
+                break
+        if not bucket:
+            del self._index[key]
+        del self._added[id(record)]
+
+    def add(self, dest_ip, src_ip, packettype, response, now=0, masq_ip=None):
+        """Add a record of the packet and what we should do when we encounter its response
+        Args:
+            dest_ip: the IP address of the destination
+            src_ip: the IP address of the source
+            packettype: 'ping, ping-response, etc.
+            response: One of  none|accept|masq|drop|reject
+            now: float - the simulation time
+            masq_ip: the IP address the packet is masqueraded as, if any
+        returns: the new record
+        """
+        self.expire(now)
+        src = packet.justIP(src_ip)
+        record = {
+            "dest": packet.justIP(dest_ip),
+            "src": src if masq_ip is None else packet.justIP(masq_ip),
+            "packettype": packettype.lower(),
+            "response": response.lower(),
+            "masqsrc": src,
+        }
+        self.records.append(record)
+        self._file(record, now)
+        if len(self.records) > MAX_IP_CONNECTIONS:
+            self._drop_oldest(len(self.records) - MAX_IP_CONNECTIONS)
+        return record
+
+    def consume(self, dest_ip, src_ip, packettype, now=0):
+        """Find the connection a packet replies to, and forget it
+        Args:
+            dest_ip: the IP address of the destination
+            src_ip: the IP address of the source
+            packettype: 'ping, ping-response, etc.
+            now: float - the simulation time
+        returns: the connection record, or None if the packet is not a reply
+        """
+        self.expire(now)
+        dest_ip = packet.justIP(dest_ip)
+        src_ip = packet.justIP(src_ip)
+        check_type = packettype
+        if packettype == "ping-response":
+            check_type = "ping"
+        if packettype == "traceroute-request":
+            check_type = "traceroute-response"
+
+        for record in self._index.get((dest_ip, src_ip, check_type), ()):
+            if (
+                record["dest"] == dest_ip
+                and record["src"] == src_ip
+                and record["packettype"] == packettype
+            ):
+                # outbound packet
+                continue
+            # Connection has been consumed. Remove it now.  Other records can be
+            # equal to this one, so find it by identity, the way _added is keyed.
+            self._unfile(record)
+            for position, onerec in enumerate(self.records):
+                if onerec is record:
+                    del self.records[position]
+                    break
+            self.matched += 1
+            return record
+        self.unmatched += 1
+        return None
+
+    def expire(self, now):
+        """Forget the connections that are too old to ever see a reply."""
+        if self.lifetime is None:
+            return
+        cutoff = now - self.lifetime
+        count = 0
+        for record in self.records:
+            if self._added[id(record)] >= cutoff:
+                break
+            count += 1
+        if count:
+            self._drop_oldest(count)
+
+    def _drop_oldest(self, count):
+        for record in self.records[:count]:
+            self._unfile(record)
+        del self.records[:count]
+        self.evicted += count
+
+    def clear(self):
+        """Forget every connection; the counters are kept."""
+        self.records.clear()
+        self._index.clear()
+        self._added.clear()
+
+
+class FirewallRules:
+    """A device's firewall rules, compiled so that a packet is checked with one lookup.
+
+    As always, the first rule for an in/out interface pair that allows or drops
+    decides; actions are compared without regard to case.
+    """
+
+    def __init__(self, rules: list, hits: Counter | None = None):
+        """
+        Args:
+            rules: list - the device's firewall rule records, in order
+            hits: Counter - how many packets each rule has decided, by `rule_key`
+        """
+        self.rules = rules
+        self.hits = Counter() if hits is None else hits
+        # (in-interface, out-interface) -> (True to allow, the deciding rule record)
+        self._verdicts = {}
+        for onerule in rules:
+            source, destination, action = self.rule_key(onerule)
+            if (source, destination) not in self._verdicts and action in (
+                "allow",
+                "drop",
+            ):
+                self._verdicts[(source, destination)] = (action == "allow", onerule)
+
+    @staticmethod
+    def rule_key(onerule: dict) -> tuple:
+        """Return the (source, destination, action) a rule record stands for."""
+        return (
+            onerule.get("source"),
+            onerule.get("destination"),
+            str(onerule.get("action")).lower(),
+        )
+
+    def verdict(self, in_interface: str, out_interface: str) -> bool | None:
+        """Return True if the rules allow the packet through, False if they drop it,
+        or None if no rule covers it."""
+        entry = self._verdicts.get((in_interface, out_interface))
+        return None if entry is None else entry[0]
+
+    def record_hit(self, in_interface: str, out_interface: str):
+        """Count a packet against the rule that decided it, if any."""
+        entry = self._verdicts.get((in_interface, out_interface))
+        if entry is not None:
+            self.hits[self.rule_key(entry[1])] += 1
+
+    def rule_hits(self, onerule: dict) -> int:
+        """Return how many packets a rule record has decided.  A rule hidden by an
+        earlier rule for the same interfaces never decides anything."""
+        entry = self._verdicts.get((onerule.get("source"), onerule.get("destination")))
+        if entry is None or entry[1] is not onerule:
+            return 0
+        return self.hits[self.rule_key(onerule)]
+
+
 def buildGlobalMACList():
     """Build/rebuild the global MAC list.  Should be run when we load a new puzzle, when we change IPs, or add/remove NICs."""
     # global maclist
+    session.puzzle.invalidate("arp")
     session.maclist = []  # clear it out
     for onedevice in session.puzzle.devices:
         if onedevice:
@@ -1775,35 +1928,17 @@ def globalArpLookup(ip):
     Returns:
         The MAC address corresponding to the IP as a string or None.
     """
-    buildGlobalMACList()
-    if isinstance(ip, str):
-        if ip == "0.0.0.0":
-            return None  # Never find a mac for this.  Possible many devices would match and it it not a valid IP
-        ip = ipaddress.IPv4Address(ip)
-        # print ("globalARP: Converting ip: " + str(ip))
-    else:
-        if packet.isEmpty(str(ip)):
-            return None  # Never find a mac for this.  Possible many devices would match and it it not a valid IP
-    for oneMac in session.maclist:
-        # print ("globalARP: comparing: " + packet.justIP(oneMac['ip']) + " to " + packet.justIP(ip))
-        if packet.justIP(oneMac["ip"]) == packet.justIP(ip):
-            return oneMac["mac"]
-    return None
+    if packet.isEmpty(str(ip)):
+        return None  # Never find a mac for this.  Possible many devices would match and it it not a valid IP
+    return session.puzzle.arp_lookup(ip)
 
 
 def devicename_from_mac(mac: str):
-    buildGlobalMACList()
-    for oneMac in session.maclist:
-        if packet.justIP(oneMac["mac"]) == packet.justIP(mac):
-            # we found the IP
-            tip = oneMac["ip"]
-            # logging.debug(f"found IP for mac: {tip} {mac}")
-            tdevice = session.puzzle.device_from_ip(packet.justIP(tip))
-            if tdevice is not None:
-                # logging.debug(f"found mac address: {mac} at device {tdevice.get('hostname')}")
-                return tdevice.get("hostname")
-    logging.debug(f"could not find host for mac: {mac}")
-    return ""
+    hostname = session.puzzle.device_name_from_mac(mac)
+    if hostname is None:
+        logging.debug(f"could not find host for mac: {mac}")
+        return ""
+    return hostname
 
 
 def getDeviceNicFromLinkNicRec(linkNicRec):
@@ -1828,7 +1963,6 @@ def deviceFromIP(what):
     for oneDevice in session.puzzle.devices:
         if oneDevice:
             for oneNic in oneDevice.get("nic"):
-                conform_json_values(oneNic, "interface")
                 for oneInterface in oneNic.get("interface"):
                     if oneInterface.get("myip").get("ip") == what:
                         return oneDevice
@@ -2051,10 +2185,8 @@ def DeviceIPs(src, ignoreLoopback=True):
     if srcDevice is None:
         logging.error("Error: passed in an invalid source to function: sourceIP")
         return None
-    conform_json_values(srcDevice, "nic")
     for onenic in srcDevice.get("nic"):
         # Pull out all the nic interfaces
-        conform_json_values(onenic, "interface")
         for oneinterface in onenic["interface"]:
             # add it to the list
             if oneinterface.get("nicname") == "lo0" and ignoreLoopback:
@@ -2088,10 +2220,8 @@ def allIPStrings(src, ignoreLoopback=True, appendInterfacNames=False):
     if srcDevice is None:
         logging.error("Error: passed in an invalid source to function: sourceIP")
         return None
-    conform_json_values(srcDevice, "nic")
     for onenic in srcDevice["nic"]:
         # Pull out all the nic interfaces
-        conform_json_values(onenic, "interface")
         if onenic["nictype"][0] == "port" or onenic["nictype"][0] == "wport":
             # skip this interface if we are told to do so
             continue
@@ -2103,13 +2233,6 @@ def allIPStrings(src, ignoreLoopback=True, appendInterfacNames=False):
             # print("Making list of ips:" + oneinterface['myip']['ip'] + "/" + oneinterface['myip']['mask'])
             if appendInterfacNames:
                 if onenic["nictype"][0] == "vpn":
-                    if "encryptionkey" not in onenic or onenic["encryptionkey"] is None:
-                        onenic["encryptionkey"] = ""
-                    if (
-                        "tunnelendpoint" not in onenic
-                        or onenic["tunnelendpoint"] is None
-                    ):
-                        onenic["tunnelendpoint"] = {"ip": ""}
                     interfacelist.append(
                         oneinterface["nicname"]
                         + " "
@@ -2145,15 +2268,9 @@ def deviceHasIP(deviceRec, IPString: str):
         if tocheck == packet.justIP(oneIP):
             logging.debug(f"Device does have the IP: {IPString}")
             return True
-        try:
-            device_IP = ipaddress.IPv4Interface(oneIP)
-            logging.debug(
-                f"checking if device has broadcast IP {device_IP.network.broadcast_address} {IPString}"
-            )
-            if str(device_IP.network.broadcast_address) == str(IPString):
-                return True
-        except ValueError:
-            continue
+        network = ipv4_network(oneIP)
+        if network is not None and ipv4_int(str(IPString)) == network[2]:
+            return True
     return False
 
 
@@ -2161,7 +2278,6 @@ def ip_is_broadcast_for_device(deviceRec, ipstr: str):
     """Return True if the specified ipstring is a broadcast IP for any of the interfaces defined on the device"""
     # FIXME: This should be a Device class method.
     # logging.debug("Checking to see if our device has a broadcast IP")
-    conform_json_values(deviceRec, "nic")
     for onenic in deviceRec["nic"]:
         # logging.debug(f"    Checking {onenic} {ipstr}")
         nic = Nic(onenic)
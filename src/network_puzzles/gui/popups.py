@@ -219,6 +219,7 @@ class EditFirewallPopup(DevicePopup):
             cmd = f"firewall {self.device.hostname} del {src} {dst} {action}"
             # TODO: This will be obsolete when undo becomes based on states.
             self.device.firewall_rules.remove(rule_data)
+            self.device.firewall_changed()
             self.app.ui.parse(cmd)
             self.ids.firewall_rules_list.update_data()
 
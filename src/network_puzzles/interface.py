@@ -1,6 +1,8 @@
 import ipaddress
 from copy import deepcopy
+from functools import lru_cache
 
+from . import session
 from .core import ItemBase, conform_json_values
 
 BROADCAST_MAC = "FFFFFFFFFFFF"
@@ -15,6 +17,45 @@ UNSET_IP4_CONFIG = {
 }
 
 
+# Puzzles only have a few dozen addresses, but they are checked over and over
+# while packets move; each distinct string is parsed once.
+@lru_cache(maxsize=4096)
+def ipv4_int(text: str) -> int | None:
+    """Return an IPv4 address string as a 32-bit int, or None if it is not one."""
+    try:
+        return int(ipaddress.IPv4Address(text))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=4096)
+def ipv4_network(text: str) -> tuple | None:
+    """Return (network, netmask, broadcast) as 32-bit ints for an IPv4 "ip/mask" string.
+    The ip may have host bits set.  A bare ip is treated as a /32.
+    returns: the tuple, or None if the string is not an IPv4 network
+    """
+    try:
+        network = ipaddress.IPv4Network(text, strict=False)
+    except ValueError:
+        return None
+    return (
+        int(network.network_address),
+        int(network.netmask),
+        int(network.broadcast_address),
+    )
+
+
+@lru_cache(maxsize=4096)
+def ip_interface(text: str):
+    """Return ipaddress.ip_interface(text), or None if the string is not valid.
+    The returned objects are immutable, so they are shared between callers.
+    """
+    try:
+        return ipaddress.ip_interface(text)
+    except ValueError:
+        return None
+
+
 class Interface(ItemBase):
     def __init__(self, json_data=None):
         super().__init__(json_data)
@@ -35,20 +76,23 @@ class Interface(ItemBase):
 
     @property
     def ip_obj(self):
-        if self._ip_obj is None:
+        # The IP data may be swapped out while this wrapper is shared.
+        if self._ip_obj is None or self._ip_obj.json is not self.ip_data:
             self._ip_obj = IpAddress(self.ip_data)
         return self._ip_obj
 
     @property
     def ipaddress(self) -> dict:
-        if self._ipaddress is None:
-            try:
-                self._ipaddress = ipaddress.ip_interface(
-                    f"{self.ip_obj.address}/{self.ip_obj.netmask}"
-                )
-            except ValueError:
-                pass
-        return self._ipaddress
+        # Kept with the address it came from, as the IP may be changed in place.
+        address = f"{self.ip_obj.address}/{self.ip_obj.netmask}"
+        if self._ipaddress is None or self._ipaddress[0] != address:
+            self._ipaddress = (address, ip_interface(address))
+        return self._ipaddress[1]
+
+    @property
+    def network_ints(self) -> tuple | None:
+        """(network, netmask, broadcast) as 32-bit ints, or None if the IP is not valid IPv4."""
+        return ipv4_network(f"{self.ip_obj.address}/{self.ip_obj.netmask}")
 
     @property
     def netmask(self) -> str:
@@ -90,6 +134,7 @@ class IpAddress(ItemBase):
     @address.setter
     def address(self, value):
         self.json["ip"] = value
+        self._addressing_changed()
 
     @property
     def netmask(self) -> str:
@@ -98,6 +143,7 @@ class IpAddress(ItemBase):
     @netmask.setter
     def netmask(self, value):
         self.json["mask"] = value
+        self._addressing_changed()
 
     @property
     def gateway(self) -> str:
@@ -107,6 +153,11 @@ class IpAddress(ItemBase):
     def gateway(self, value):
         self.json["gateway"] = value
 
+    def _addressing_changed(self):
+        # Popups edit addresses in place, so the lookups built from them go stale.
+        if session.puzzle:
+            session.puzzle.invalidate("arp", "fib")
+
     def __str__(self):
         return (
             f"{self.__class__.__name__}({self.address}/{self.netmask} {self.gateway})"
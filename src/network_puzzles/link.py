@@ -97,3 +97,52 @@ class Link(ItemBase):
         session.print(f"type: {self.linktype}")
         session.print(f"source: {self.src} - {self.src_nic_name}")
         session.print(f"dest: {self.dest} - {self.dest_nic_name}")
+
+
+class BroadcastDomains:
+    """Which network cards can hear each other's broadcasts, kept as a union-find.
+
+    Cards are joined by the links between them, and by the hubs, switches and
+    wireless devices that pass broadcasts between their own cards. Joining is
+    cheap, so new links are added as they are made; splitting a domain means
+    building the whole thing again.
+    """
+
+    def __init__(self):
+        self._parent = {}
+        self._members = None
+
+    def add(self, nic_id):
+        """Make sure a network card is known, in a domain of its own if it is new."""
+        if nic_id not in self._parent:
+            self._parent[nic_id] = nic_id
+            self._members = None
+
+    def find(self, nic_id):
+        """Return the id that stands for the network card's domain, or None if the card is unknown."""
+        if nic_id not in self._parent:
+            return None
+        parent = self._parent
+        while parent[nic_id] != nic_id:
+            parent[nic_id] = parent[parent[nic_id]]
+            nic_id = parent[nic_id]
+        return nic_id
+
+    def union(self, nic_a, nic_b):
+        """Put two network cards, and everything they can already reach, in one domain."""
+        self.add(nic_a)
+        self.add(nic_b)
+        root_a = self.find(nic_a)
+        root_b = self.find(nic_b)
+        if root_a != root_b:
+            self._parent[root_b] = root_a
+            self._members = None
+
+    def members(self, nic_id) -> frozenset:
+        """Return the ids of every network card in the same domain, or an empty set if the card is unknown."""
+        if self._members is None:
+            groups = {}
+            for one_id in self._parent:
+                groups.setdefault(self.find(one_id), set()).add(one_id)
+            self._members = {root: frozenset(ids) for root, ids in groups.items()}
+        return self._members.get(self.find(nic_id), frozenset())
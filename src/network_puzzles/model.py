@@ -0,0 +1,29 @@
+"""Names for the kinds of things a puzzle holds.
+
+The members are strings, so they compare equal to, and can be stored as, the
+values in the puzzle JSON.
+"""
+
+from enum import StrEnum
+
+
+class NicType(StrEnum):
+    ETH = "eth"
+    LO = "lo"
+    MANAGEMENT_INTERFACE = "management_interface"
+    PORT = "port"
+    VPN = "vpn"
+    WAN = "wan"
+    WLAN = "wlan"
+    WPORT = "wport"
+
+
+class PacketType(StrEnum):
+    DHCP = "dhcp"
+    DHCP_REQUEST = "dhcp-request"
+    DHCP_RESPONSE = "dhcp-response"
+    PING = "ping"
+    PING_RESPONSE = "ping-response"
+    TRACEROUTE_REQUEST = "traceroute-request"
+    TRACEROUTE_RESPONSE = "traceroute-response"
+    TUNNEL = "tunnel"
@@ -1,3 +1,5 @@
+from collections import deque
+
 from . import messages
 from .core import ItemBase
 
@@ -44,3 +46,98 @@ class NetTest(ItemBase):
             case 0 | _:
                 key = None
         return key
+
+
+class NetTestIndex:
+    """A puzzle's tests, indexed by the hosts they are about.
+
+    The index holds the test records themselves, so a test marked as completed
+    is seen as completed here straight away.  It also keeps count of the tests
+    still to be done, and of the completed ones the player has not been told
+    about; tests should be completed through `complete` to keep those right.
+    """
+
+    def __init__(self, tests: list):
+        """
+        Args: tests: list - the puzzle's test records, in order
+        """
+        self.tests = tests
+        self.by_host = {}  # shost -> tests, in order
+        self.kinds = {}  # shost -> names of the tests on it
+        self.critical = set()  # every host named by a test
+        self._first = {}  # (shost, dhost, thetest) -> first matching test
+        self._first_for_host = {}  # (shost, thetest) -> first matching test
+        self._first_for_dhost = {}  # (dhost, thetest) -> first matching test
+        self.outstanding = 0  # tests not completed yet; Lock tests do not count
+        self.unacknowledged = deque()  # completed tests not yet shown to the player
+        for test in tests:
+            shost = test.get("shost")
+            dhost = test.get("dhost")
+            thetest = test.get("thetest")
+            self.by_host.setdefault(shost, []).append(test)
+            self.kinds.setdefault(shost, set()).add(thetest)
+            for host in (shost, dhost):
+                if host:
+                    self.critical.add(host)
+            self._first.setdefault((shost, dhost, thetest), test)
+            self._first_for_host.setdefault((shost, thetest), test)
+            self._first_for_dhost.setdefault((dhost, thetest), test)
+            if not test.get("completed", False):
+                if _counts_toward_solving(test):
+                    self.outstanding += 1
+            elif not test.get("acknowledged"):
+                self.unacknowledged.append(test)
+
+    def find(self, shost, dhost, thetest):
+        """Return the first test with the given hosts and name, or None."""
+        return self._first.get((shost, dhost, thetest))
+
+    def find_for_host(self, shost, thetest):
+        """Return the first test of the given name on a host, whatever its dhost, or None."""
+        return self._first_for_host.get((shost, thetest))
+
+    def find_for_dhost(self, dhost, thetest):
+        """Return the first test of the given name aimed at a host, whatever its shost, or None."""
+        return self._first_for_dhost.get((dhost, thetest))
+
+    def is_locked(self, shost, whattocheck, dhost=None) -> bool:
+        """Return True if a Lock test keeps the host from being changed.
+        Args:
+            shost: str - the hostname of the device
+            whattocheck: str - the lock to check for, e.g. "LockIP"
+            dhost: str - what the lock is about (a nic, a hostname, ...), if it matters
+        """
+        kinds = self.kinds.get(shost)
+        if not kinds:
+            return False
+        # LockAll does not include locking the location
+        if "LockAll" in kinds and whattocheck != "LockLocation":
+            return True
+        if whattocheck not in kinds:
+            return False
+        if whattocheck in ("LockLocation", "LockVlanNames", "LockVLANsOnHost"):
+            return True
+        return bool(dhost) and self.find(shost, dhost, whattocheck) is not None
+
+    def complete(self, test, message):
+        """Mark a test as completed, with the message to show the player."""
+        if not test.get("completed", False):
+            if _counts_toward_solving(test):
+                self.outstanding -= 1
+            self.unacknowledged.append(test)
+        elif test.get("acknowledged"):
+            self.unacknowledged.append(test)
+        test["completed"] = True
+        test["acknowledged"] = False
+        test["message"] = message
+
+    def reopen(self, test):
+        """Mark a completed test as not done after all."""
+        if test.get("completed", False) and _counts_toward_solving(test):
+            self.outstanding += 1
+        test["completed"] = False
+
+
+def _counts_toward_solving(test):
+    # Lock tests are never completed; they only stop the player changing things.
+    return not (test.get("thetest") or "").startswith("Lock")
@@ -2,7 +2,7 @@ import logging
 import random
 
 from . import interface, packet, session
-from .core import ItemBase, conform_json_values
+from .core import ItemBase, conform_json_values, json_bool
 from .link import Link
 
 
@@ -18,10 +18,8 @@ class Nic(ItemBase):
     @property
     def can_use_dhcp(self):
         if self._can_use_dhcp is None:
-            if self.type in ("eth", "management_interface", "wlan"):
-                self._can_use_dhcp = True
-            else:
-                self._can_use_dhcp = False
+            # Not kept, as the type can change while the wrapper is shared.
+            return self.type in ("eth", "management_interface", "wlan")
         return self._can_use_dhcp
 
     @can_use_dhcp.setter
@@ -49,7 +47,7 @@ class Nic(ItemBase):
 
     @property
     def interfaces(self):
-        return [interface.Interface(d) for d in self.interfaces_data]
+        return [interface.Interface.shared(d) for d in self.interfaces_data]
 
     @property
     def ip_addresses(self):
@@ -84,13 +82,15 @@ class Nic(ItemBase):
     def type(self):
         # NOTE: The JSON data defines nictype as a list of two identical
         # strings. We simply return the first one.
-        if self.json.get("nictype") is None:
-            self.type = ""
-        return self.json.get("nictype")[0]
+        nictype = self.json.get("nictype")
+        return nictype[0] if nictype else ""
 
     @type.setter
     def type(self, value):
         self.json["nictype"] = [value, value]
+        if session.puzzle:
+            session.puzzle.invalidate("arp", "fib", "wireless", "domains")
+            session.puzzle.mark_wireless_dirty(self.my_id.hostname)
 
     @property
     def uniqueidentifier(self):
@@ -98,10 +98,7 @@ class Nic(ItemBase):
 
     @property
     def encryption_key(self):
-        if self.json.get("encryptionkey") is None:
-            # Some JSON files have this set as `null`, which translates to
-            # `None`, but we need a string for GUI use.
-            self.json["encryptionkey"] = ""
+        # Puzzle files with this set as `null` are fixed up at load time.
         return self.json.get("encryptionkey", "")
 
     @encryption_key.setter
@@ -111,6 +108,9 @@ class Nic(ItemBase):
         if "," in value:
             raise ValueError("Invalid character: ,")
         self.json["encryptionkey"] = value
+        if session.puzzle:
+            session.puzzle.invalidate("wireless")
+            session.puzzle.mark_wireless_dirty(self.my_id.hostname)
 
     @property
     def ssid(self):
@@ -119,6 +119,9 @@ class Nic(ItemBase):
     @ssid.setter
     def ssid(self, value: str):
         self.json["ssid"] = value
+        if session.puzzle:
+            session.puzzle.invalidate("wireless")
+            session.puzzle.mark_wireless_dirty(self.my_id.hostname)
 
     @property
     def endpoint(self):
@@ -136,9 +139,7 @@ class Nic(ItemBase):
 
     @property
     def uses_dhcp(self):
-        if self.json.get("usesdhcp") is None:
-            self.json["usesdhcp"] = "false"
-        return self.json.get("usesdhcp").lower() in ["true", "yes"]
+        return json_bool(self.json.get("usesdhcp"))
 
     @uses_dhcp.setter
     def uses_dhcp(self, value):
@@ -195,27 +196,9 @@ class Nic(ItemBase):
         # If we are entering a WAN port, see if we should be blocked or if it is a return packet
         if self.type == "vpn":
             logging.debug(f"Coming in a VPN link: {pkt.json}")
-        if self.type == "wan":
-            connection_info = dev.ReturnIPConnectionEntry(
-                pkt.destination_ip, pkt.source_ip, pkt.packettype
-            )
-            if connection_info is not None:
-                logging.debug(f"Found a return packet: {connection_info}")
-                if connection_info["response"] == "masq":
-                    logging.debug(
-                        f"Packet was masqueraded.  Switching it back {connection_info['src']} -> {connection_info['masqsrc']}"
-                    )
-                    pkt.destination_ip = connection_info["masqsrc"]
-            else:
-                # we do not have a record of this.  Packets coming into the WAN, unless it is destined for here, are dropped.
-                # see if the packet is destined for us.
-                t_nic = dev.nic_from_ip(pkt.destination_ip)
-                if t_nic is None:
-                    logging.debug(
-                        "No record of this and not destined for this machine.  Drop it for now"
-                    )
-                    pkt.status = "done"
-                    return False
+        if self.type == "wan" and not dev.admit_from_wan(pkt):
+            pkt.status = "done"
+            return False
         if pkt.destination_mac is None:
             # The packet was improperly crafted or no such machine exists.  Drop
             logging.debug(
@@ -225,14 +208,7 @@ class Nic(ItemBase):
             return False
 
         # logging.debug(f"Nic.begin_ingress: {dev.json=}")
-        if (
-            pkt.destination_mac == self.mac
-            or packet.is_broadcast_mac(pkt.destination_mac)
-            or dev.routes_packets
-            or dev.is_wireless_forwarder
-            or self.type == "port"
-            or self.type == "wport"
-        ):
+        if self.accepts(pkt, dev):
             # The packet is good, and has reached the computer.  Pass it on to the device
             logging.debug(f"Packet entering device: {dev.hostname}")
             return dev.receive_packet(pkt, self)
@@ -292,66 +268,63 @@ class Nic(ItemBase):
         # logging.debug(
         #    f"looking for link connected to nic; #{self.my_id.nic_id}; {self.name}"
         # )
-        for one in session.puzzle.links:
-            if one:
-                # print ("   link - " + one['hostname'])
-                if one["SrcNic"]["nicid"] == self.my_id.nic_id:
-                    return one
-                if one["DstNic"]["nicid"] == self.my_id.nic_id:
-                    return one
-        # we did not find anything that matched.  Return None
-        return None
+        return session.puzzle.link_from_nic_id(self.my_id.nic_id)
 
     def is_connected(self):
         """Connected status of given interface.
+        The link is matched on the device and card names at its end, which some
+        puzzles have out of step with the card ids get_connected_link() uses.
         returns: boolean
         """
-        for link_data in session.puzzle.links:
-            link = Link(link_data)
-            # Check if NIC is used by host device as src or dest.
-            if (
-                self.my_id.hostname == link.src and self.name == link.src_nic.nic_name
-            ):  # NIC used as link src
-                if link.linktype == "broken":
-                    return False
-                else:
-                    return True
-            if (
-                self.my_id.hostname == link.dest and self.name == link.dest_nic.nic_name
-            ):  # NIC used as link dest
-                if link.linktype == "broken":
-                    return False
-                else:
-                    return True
-        return False
+        link_data = session.puzzle.link_from_nic_name(self.my_id.hostname, self.name)
+        if link_data is None:
+            return False
+        return Link(link_data).linktype != "broken"
+
+    def ingress_interface(self, tdest_ip) -> str:
+        """Return the name of the interface a packet comes in on.
+        Args: tdest_ip: the gateway the sender routed the packet through, if any
+        returns: str - the interface with that IP, or else the primary one; "" if
+            there is neither, as on a switch/hub port
+        """
+        tInterface = self.find_local_interface(tdest_ip)
+        # if this is None, try the primary interface, which is always Nic.type.
+        if tInterface is None:
+            tInterface = self.find_primary_interface()
+        if tInterface is None:
+            return ""
+        logging.debug(f"Beginning on interface: {tInterface}")
+        # FIXME: if tInterface is "primary interface", it will only be a str
+        # rather than JSON data, which will cause a ValueError if we go on to
+        # call interface.Interface(tInterface).begin_ingress(pkt).  But since
+        # that currently always returns True, we skip it for now.
+        if isinstance(tInterface, str):
+            return tInterface
+        return tInterface.get("nicname")
+
+    def accepts(self, pkt, dev) -> bool:
+        """Return True if the packet's destination MAC lets it into the device.
+        Args:
+            pkt: packet.Packet - the packet coming in on this card
+            dev: device.Device - the device this card is in
+        """
+        return (
+            pkt.destination_mac == self.mac
+            or packet.is_broadcast_mac(pkt.destination_mac)
+            or dev.routes_packets
+            or dev.is_wireless_forwarder
+            or self.type == "port"
+            or self.type == "wport"
+        )
 
     def receive_packet(self, pkt, dev, nic=None):
         # logging.debug(f"Nic.receive_packet: at {dev.hostname=}")
-        # Zero this out. We will set it below.
-        pkt.in_interface = ""
-
         # If the packet is a DHCP answer, process that here.  To be done later
         # If the packet is a DHCP request, and this is a DHCP server, process that.  To be done later.
 
         # Find the network interface.  It might be none if the IP does not match, or if it is a switch/hub device.
-        tInterface = self.find_local_interface(pkt.json.get("tdestIP"))
-        # if this is None, try the primary interface, which is always Nic.type.
-        if tInterface is None:
-            tInterface = self.find_primary_interface()
-        # the interface still might be none if we are a switch/hub port
-        # Verify the interface.  This is mainly to work with SSIDs, VLANs, VPNs, etc.
-        if tInterface is not None:
-            # we track where it came in on.  We do it it here to track vlan info too.
-            if isinstance(tInterface, str):
-                pkt.in_interface = tInterface
-            else:
-                pkt.in_interface = tInterface.get("nicname")
-            logging.debug(f"Beginning on interface: {tInterface}")
-            # FIXME: if tInterface is "primary interface", it will only be a str
-            # rather than JSON data, which will cause a ValueError here. But
-            # since this currently always returns True, we'll just skip it for
-            # now.
-            # interface.Interface(tInterface).begin_ingress(pkt)
+        # We track where it came in on.  We do it it here to track vlan info too.
+        pkt.in_interface = self.ingress_interface(pkt.json.get("tdestIP"))
 
         # the packet status should show dropped or something if we have a problem.
         # but for now, pass it onto the NIC
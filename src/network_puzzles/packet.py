@@ -1,25 +1,18 @@
 import ipaddress
 import logging
-import re
-import time
 from copy import deepcopy
 
 from . import device, session
-from .core import ItemBase, conform_json_values, get_puzzle_distance
-from .interface import BROADCAST_MAC, GENERIC_IP4, IpAddress
+from .core import ItemBase, conform_json_values
+from .interface import BROADCAST_MAC, GENERIC_IP4, IpAddress, ipv4_int, ipv4_network
 from .link import Link
+from .model import PacketType
 from .nic import Nic
 
-PACKET_TYPES = (
-    "dhcp",
-    "dhcp-request",
-    "dhcp-response",
-    "ping",
-    "ping-response",
-    "traceroute-request",
-    "traceroute-response",
-    "tunnel",
-)
+EMPTY_IP4_ADDRESS = ipaddress.IPv4Address(GENERIC_IP4)
+EMPTY_IP4_INTERFACE = ipaddress.IPv4Interface(f"{GENERIC_IP4}/0")
+
+PACKET_TYPES = tuple(PacketType)
 
 
 class Packet(ItemBase):
@@ -47,8 +40,8 @@ class Packet(ItemBase):
         if json_data is None:
             # deepcopy keeps class attribute from being changed.
             json_data = deepcopy(self.EMPTY_PACKET_JSON)
-            # Seconds since epoc. Failsafe that will kill the packet if too much time has passed
-            json_data["starttime"] = int(time.time() * 1000)
+            # Simulation time. Failsafe that will kill the packet if too much time has passed
+            json_data["starttime"] = session.puzzle.sim_time if session.puzzle else 0
         super().__init__(json_data)
         self.session = session
         # TODO: Consider adding packet data to puzzle JSON for comprehensive tracking.
@@ -246,6 +239,34 @@ class Packet(ItemBase):
         value = int(value)
         self.json["TTL"] = value
 
+    def clone(self):
+        """Copy the packet cheaply, e.g. to flood it out every port of a switch.
+        Only the values a copy changes by itself (location, direction, distance,
+        path, etc.) are its own; payload data is shared, so copy it before editing it.
+        returns: Packet
+        """
+        json_data = dict(self.json)
+        if "path" in json_data:
+            json_data["path"] = list(self.path)
+        if isinstance(json_data.get("payload"), Packet):
+            # A tunneled packet is unpacked and moved on its own; give it its own copy.
+            json_data["payload"] = json_data["payload"].clone()
+        return Packet(json_data)
+
+    def enter_link(self, link_data, hostname):
+        """Put the packet at the start of a link, leaving the given device.
+        Args:
+            link_data: dict - the link JSON
+            hostname: str - the device the packet leaves from
+        """
+        self.packet_location = link_data.get("hostname")
+        # Reset distance to the beginning of the link.
+        self.distance = 0
+        if link_data["SrcNic"]["hostname"] == hostname:
+            self.direction = 1  # Src to Dest
+        else:
+            self.direction = 2  # Dest to Source
+
     def add_to_packet_list(self):
         """Convenience function for managing packets."""
         self.session.puzzle.packets.append(self)
@@ -262,71 +283,37 @@ class Packet(ItemBase):
             f"removed packet.  Packets left: {len(self.session.puzzle.packets)}"
         )
 
-    def apply_possible_damage(self, tick_pct):
+    def apply_possible_damage(self, tick_pct, lnk=None):
         """Damage the packet if near enough to microwave (wireless connection) or light (wired connection)."""
         # Find link that packet is traveling on.
-        lnk = self.get_current_link()
+        if lnk is None:
+            lnk = self.get_current_link()
         if lnk is None:
             logging.warning(
                 f"Unable to apply damage because no `Link` found for `Packet`: {self.json}"
             )
             return
 
-        devices = self.get_current_link_endpoint_devices()
-        if devices is None or not isinstance(devices, tuple):
+        # Which devices damage the packet where along the link only changes when
+        # things move, so the puzzle keeps it for us.
+        profile = self.session.puzzle.damage_profile(self, lnk)
+        if profile is None:
             return None
-        src_device, dest_device = devices
-        sx, sy = src_device.location
-
-        # List damage-causing devices in puzzle.
-        risky_devices = []
-        for dev_json in self.session.puzzle.devices:
-            dev = device.Device(dev_json)
-            if dev.mytype == "tree" and lnk.linktype == "wireless":
-                risky_devices.append(dev)
-            if dev.mytype == "microwave" and lnk.linktype == "wireless":
-                risky_devices.append(dev)
-            if dev.mytype == "fluorescent" and lnk.linktype != "wireless":
-                risky_devices.append(dev)
+        risky_devices, weak_signal_pcts = profile
 
         # We only need to calculate these values once.
-        all_points = self.get_distance_points(tick_pct)
+        all_pcts = self.get_distance_pcts(tick_pct)
 
         # Check if each device is close enough to damage packet.
-        for dev in risky_devices:
-            # We need to check for damage.
-            dx, dy = dev.location
-            # calculate the centerpoint
-            halfsize = int(
-                dev.size / 2
-            )  # all devices in EduNetworkBuilder were 100 size
-            dx += halfsize
-            dy += halfsize
-
-            # for microwaves and fluorescent...
-            damage_distance = 43
-            if dev.mytype == "tree":
-                # it needs to hit the tree.
-                damage_distance = 9
-
+        for dev, damaging_pcts in risky_devices:
             # Now compare locations to each point along the distance.
-            for px, py in all_points:
-                # NOTE: It seems unnecessary (or possibly erroneous) to
-                # convert the distance() value below into an int, because
-                # this would theoretically apply damage even when the
-                # distance between the objects is just beyond the threshold
-                # but happens to round down (when using int()) to the
-                # threshold. However, changing this conversion might have
-                # unintended consequences on already-designed puzzles. so it
-                # has been left as an int accordingly.
-                # Compare distance between device and packet with threshold.
-                thedistance = int(get_puzzle_distance(px, py, dx, dy))
-                if thedistance <= damage_distance:
+            for dist_pct in all_pcts:
+                if dist_pct in damaging_pcts:
                     self.health -= 1
                     self.damage_count += 1
                     if dev.mytype == "tree":
                         logging.debug(
-                            f"BOOM. Packet hit a tree. ({dev.hostname}) with a distance of {thedistance}; end of packet."
+                            f"BOOM. Packet hit a tree. ({dev.hostname}); end of packet."
                         )
                         session.print(
                             f"Packet Dropped: Wireless failed to reach other end: {lnk.hostname}"
@@ -346,38 +333,30 @@ class Packet(ItemBase):
         # Check wireless links' packets' total distance from source.
         if lnk.linktype == "wireless":
             # Check the final end point, which is farthest from the source.
-            px, py = all_points[-1]
-            total_distance = int(get_puzzle_distance(px, py, sx, sy))
-            if total_distance >= session.WirelessFailureDistance:
+            if all_pcts[-1] in weak_signal_pcts:
                 logging.debug(
-                    f"Wireless signal too weak; packet on link {lnk.hostname} from ({sx}, {sy}) to ({px}, {py}) dropped; {total_distance=}"
+                    f"Wireless signal too weak; packet on link {lnk.hostname} dropped at {all_pcts[-1]}%"
                 )
                 session.print(
                     f"Packet Dropped: Wireless signal too weak across link {lnk.hostname}"
                 )
                 self.status = "done"
 
+    def get_distance_pcts(self, tick_pct):
+        """Returns a list of the % distances along the link which will be passed during the next tick."""
+        # Stop at 100% because the packet can only travel 100% of wire.
+        return [
+            dist_pct
+            for dist_pct in range(int(self.distance), int(self.distance + tick_pct), 2)
+            if dist_pct <= 100
+        ]
+
     def get_distance_points(self, tick_pct):
         """Returns a list of (x, y) points along the link route which will be applied during the next tick."""
         devices = self.get_current_link_endpoint_devices()
         if devices is None or not isinstance(devices, tuple):
             return None
-        src_device, dest_device = devices
-        sx, sy = src_device.location
-        dx, dy = dest_device.location
-        # We now have a line that the packet is somewhere on; calculate progress.
-        deltax = (dx - sx) / 100
-        deltay = (dy - sy) / 100
-
-        points = list()
-        for dist_pct in range(int(self.distance), int(self.distance + tick_pct), 2):
-            # Stop at 100% because the packet can only travel 100% of wire.
-            if dist_pct > 100:
-                break
-            tx = sx + (deltax * dist_pct)
-            ty = sy + (deltay * dist_pct)
-            points.append((tx, ty))
-        return points
+        return link_points(*devices, self.get_distance_pcts(tick_pct))
 
     def get_current_link(self) -> Link | None:
         link_data = self.session.puzzle.link_from_name(self.packet_location)
@@ -392,7 +371,7 @@ class Packet(ItemBase):
         dest_json = self.session.puzzle.device_from_uid(dest_nic.my_id.host_id)
         if None in (src_json, dest_json):
             return None
-        return (device.Device(value=src_json), device.Device(value=dest_json))
+        return (device.Device.shared(src_json), device.Device.shared(dest_json))
 
     def get_current_link_endpoint_nics(self):
         """Return tuple of (SrcNic, DstNic)."""
@@ -404,7 +383,7 @@ class Packet(ItemBase):
             link_src_nic = current_link.dest_nic
         src_nic_data = device.getDeviceNicFromLinkNicRec(link_src_nic.json)
         dest_nic_data = device.getDeviceNicFromLinkNicRec(link_dest_nic.json)
-        return (Nic(src_nic_data), Nic(dest_nic_data))
+        return (Nic.shared(src_nic_data), Nic.shared(dest_nic_data))
 
     def __str__(self):
         return f"<packet: {self.packettype} from {self.source_ip} to {self.destination_ip}>"
@@ -436,8 +415,7 @@ def justIP(ip):
     """return just the IP address as a string, stripping the subnet if there was one"""
     if not isinstance(ip, str):
         ip = str(ip)  # change it to a string
-    ip = re.sub("/.*", "", ip)
-    return ip
+    return ip.partition("/")[0]
 
 
 def get_ip_range(start_ip, end_ip):
@@ -469,6 +447,10 @@ def isLocal(packetIP: IpAddress | str, interfaceIP: IpAddress | str):
         packetIP:str - a string IP (ipv6/ipv4); just an IP - no subnet
         interfaceIP:str - an IP/subnet, either iPv4 or ipv6"""
     t_packetIP = justIP(packetIP)
+    ip = ipv4_int(t_packetIP)
+    network = ipv4_network(str(interfaceIP))
+    if ip is not None and network is not None:
+        return ip & network[1] == network[0]
     try:
         ip = ipaddress.ip_address(t_packetIP)
         network = ipaddress.ip_network(
@@ -486,6 +468,10 @@ def isBroadcast(packetIP: str, interfaceIP: str):
         packetIP:str - a string IP (ipv6/ipv4); just an IP - no subnet
         interfaceIP:str - an IP/subnet, either iPv4 or ipv6"""
     t_packetIP = justIP(packetIP)
+    ip = ipv4_int(t_packetIP)
+    network = ipv4_network(str(interfaceIP))
+    if ip is not None and network is not None:
+        return ip == network[2]
     try:
         ip = ipaddress.ip_address(t_packetIP)
         network = ipaddress.ip_network(
@@ -509,10 +495,21 @@ def isEmpty(iptocheck: str | ipaddress.IPv4Address):
         logging.debug("  Is empty")
         return True
     if isinstance(iptocheck, ipaddress.IPv4Address) and (
-        iptocheck == ipaddress.IPv4Interface(f"{GENERIC_IP4}/0")
-        or iptocheck == ipaddress.IPv4Address(GENERIC_IP4)
+        iptocheck == EMPTY_IP4_INTERFACE or iptocheck == EMPTY_IP4_ADDRESS
     ):
         # logging.debug("  Is empty")
         return True
     # logging.debug("  Not empty")
     return False
+
+
+def link_points(src_device, dest_device, dist_pcts):
+    """Return the (x, y) points at the given % distances along the line between two devices."""
+    sx, sy = src_device.location
+    dx, dy = dest_device.location
+    # We now have a line that the packet is somewhere on; calculate progress.
+    deltax = (dx - sx) / 100
+    deltay = (dy - sy) / 100
+    return [
+        (sx + (deltax * dist_pct), sy + (deltay * dist_pct)) for dist_pct in dist_pcts
+    ]
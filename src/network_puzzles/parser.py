@@ -5,7 +5,7 @@ import ipaddress
 import logging
 import sys
 
-from . import device, link, nic, packet, puzzle, session
+from . import device, link, nic, packet, puzzle, reach, session
 from .interface import GENERIC_IP4
 
 
@@ -121,6 +121,8 @@ class Parser:
                 retval = self.process_firewall(args)
             case "ping":
                 retval = self.run_ping(args)
+            case "reach":
+                retval = self.run_reach(args)
             case "replace":
                 retval = self.replace_something(args)
             case "route":
@@ -145,7 +147,7 @@ class Parser:
             and previous_state_json is not None
             and not session.puzzle.json == previous_state_json
         ):
-            if command not in ["undo", "redo", "show"]:
+            if cmd not in ["undo", "redo", "show", "reach"]:
                 # something changed.  We want to stash an undo
                 session.store_undo(command, previous_state_json)
                 # zero out the redo if we have done anything except an undo/redo
@@ -153,8 +155,9 @@ class Parser:
 
             # we only need to do this if something changed.
             # after we do anything, rebuild network wires if needed.
+            # Each change has already dropped the cached lookups it affects.
             if session is not None and session.puzzle is not None:
-                session.puzzle.AutoJoinAllWireless()
+                session.puzzle.rejoin_wireless()
         return retval
 
     def try_undo(self):
@@ -308,6 +311,12 @@ class Parser:
         session.print(
             "ping [host1] [host2] - ping from one host to the other.  Example: ping pc0 pc1"
         )
+        session.print(
+            "reach [host1] [host2] - check if a ping would get through, without sending one.  Example: reach pc0 pc1"
+        )
+        session.print(
+            "reach all - check every pair of devices with an IP address and show the hops in a table"
+        )
         session.print(
             "traceroute [host1] [host2] - traceroute from one host to the other.  Example: traceroute pc0 pc1"
         )
@@ -372,6 +381,67 @@ class Parser:
         # initiated, not that it was itself successful.
         return True
 
+    def run_reach(self, args):
+        if len(args) == 1 and args[0].lower() == "all":
+            return self.run_reach_matrix()
+        if len(args) != 2:
+            session.print(
+                "invalid reach command: usage: reach source_hostname destination_hostname"
+            )
+            session.print(" example: reach pc0 pc1")
+            return False
+
+        # Look for devices by hostname, then by IP address.
+        shost = session.puzzle.device_from_name(args[0])
+        dhost = session.puzzle.device_from_name(args[1])
+        if shost is None:
+            shost = session.puzzle.device_from_ip(args[0])
+        if dhost is None:
+            dhost = session.puzzle.device_from_ip(args[1])
+        if dhost is None and packet.is_ipv4(args[1]):
+            dhost = args[1]  # it is a valid IP address.  Try it.
+        if shost is None:
+            session.print(f"No such host: {args[0]}")
+            return False
+        if dhost is None:
+            session.print(f"No such host: {args[1]}")
+            return False
+        result = reach.trace_ping(shost, dhost)
+        session.print(f"REACH: {result}")
+        return result.reachable
+
+    def run_reach_matrix(self):
+        devices = reach.ip_devices()
+        if len(devices) < 2:
+            session.print("There are not enough devices with IP addresses to check.")
+            return False
+        matrix = reach.reach_matrix(devices)
+        names = [d.get("hostname") for d in devices]
+        width = max(len(name) for name in names)
+        session.print(
+            "REACH: hops from each row to each column.  - unreachable, ? unknown, ! damaged"
+        )
+        header = " " * (width + 4)
+        header += "".join(f"{col:>4}" for col in range(1, len(names) + 1))
+        session.print(header)
+        for row, src in enumerate(names, start=1):
+            cells = ""
+            for dest in names:
+                result = matrix.get((src, dest))
+                if result is None:
+                    cell = "."
+                elif result.reachable is None:
+                    cell = "?"
+                elif not result.reachable:
+                    cell = "-"
+                elif result.health < 100:
+                    cell = f"{result.hops}!"
+                else:
+                    cell = str(result.hops)
+                cells += f"{cell:>4}"
+            session.print(f"{row:>3} {src:<{width}}{cells}")
+        return all(result.reachable for result in matrix.values())
+
     def run_traceroute(self, args):
         if len(args) != 2:
             session.print(
@@ -817,6 +887,7 @@ class Parser:
                 session.print(f"Setting {dev_obj.hostname}:{nicname} to: {ip}/{mask}")
                 interface["myip"]["ip"] = ip
                 interface["myip"]["mask"] = mask
+                session.puzzle.invalidate("arp", "fib")
                 session.puzzle.check_local_IP_test(dev_obj.json)
             else:
                 session.print(f"Could not find Nic: {nicname}")
@@ -841,6 +912,8 @@ class Parser:
         if x + 0 and y > 0:
             session.print(f"Setting position of {dev_obj.hostname} to {x},{y}")
             dev_obj.json["location"] = f"{x},{y}"
+            session.puzzle.invalidate("damage", "wireless")
+            session.puzzle.mark_wireless_dirty(dev_obj.hostname)
             # TODO: We need a callback here to tell te gui to redraw. - we just moved a device
             # if we just moved a 'lost' switch, we can draw it
             if dev_obj.is_invisible:
@@ -2,30 +2,90 @@
 # All the functions needed for reading the EduNetwork Puzzle file
 # And getting information from it
 import copy
+import hashlib
 import json
 import logging
+import marshal
+import math
+import os
 import re
-import time
+from collections import Counter
 
 from packaging.version import Version
 
 # define the global network list
-from . import device, packet, session
-from .core import ItemBase, conform_json_values
+from . import __version__, device, packet, session
+from .core import ItemBase, conform_json_values, get_puzzle_distance
 
 # from .link import Link
+from .link import BroadcastDomains
+from .model import NicType
+from .nettests import NetTestIndex
 from .nic import Nic
+from .route import ForwardingTable
 from .shape import Shape
-from .vars import DATA_DIR
+from .vars import DATA_DIR, PUZZLE_CACHE_DIR
+
+# Generated list of puzzle names, levels, titles and tags; see write_catalog().
+CATALOG_FILE = DATA_DIR / "resources" / "puzzle-catalog.json"
+
+# Bump when normalize_puzzle() changes what it produces, so cached puzzles
+# (stored in PUZZLE_CACHE_DIR with marshal) are rebuilt.
+NORMALIZE_VERSION = 1
+
+# Item attributes that can be looked up without searching the puzzle data.
+INDEXED_ATTRIBS = ("hostname", "uniqueidentifier")
+
+# Network cards that a hub, switch or wireless router passes broadcasts between.
+# Access points, bridges and repeaters pass them between all of their cards.
+BRIDGED_NIC_TYPES = (NicType.PORT, NicType.WPORT, NicType.MANAGEMENT_INTERFACE)
+
+# How far a packet may travel before it is killed, in percent of a link; i.e.
+# 1200 is 12 link-lengths. This is the same distance a GUI packet used to cover
+# in 8 seconds, and it is long enough for the farthest traceroute (6 segments).
+PACKET_LIFETIME = 1200
+PACKET_LIFETIME_SECONDS = 8
+# How long a device remembers a connection while it waits for the reply.  The
+# reply starts out no later than one lifetime after the packet it answers, and
+# lives one lifetime itself.
+CONNECTION_LIFETIME = 2 * PACKET_LIFETIME
 
 
 class Puzzle(ItemBase):
     """Encapsulates the loaded puzzle's data and functionality."""
 
-    def __init__(self, json_data):
+    def __init__(self, json_data, normalized=False):
+        """
+        Args:
+            json_data: dict - the puzzle's "Network" JSON data
+            normalized: bool - True if normalize_puzzle() has already been run on it
+        """
+        self._cache = {}
+        # NAT tables by device; kept apart from the cache so their counters last.
+        self._connection_tables = {}
+        # Firewall rule hits by device, kept for the same reason.
+        self._firewall_hits = {}
+        # Hostnames whose wireless links need re-evaluating; None means all of them.
+        self._wireless_dirty = None
         super().__init__(json_data)
+        if not normalized:
+            normalize_puzzle(self.json)
         self.completion_notified = False
         self.dirty = False
+        # Simulation clock, in percent of a link traveled; advanced once per tick.
+        self.sim_time = 0
+
+    @property
+    def json(self):
+        return self._json
+
+    @json.setter
+    def json(self, value):
+        # The puzzle data gets swapped out wholesale on undo/redo, so anything
+        # derived from the old data is no longer valid.
+        self._json = value
+        self.invalidate()
+        self.mark_wireless_dirty()
 
     @property
     def default_help_level(self):
@@ -43,26 +103,12 @@ class Puzzle(ItemBase):
     @property
     def devices(self):
         """Generator to yield all devices in puzzle."""
-        for dev in self.json.get("device", []):
-            if isinstance(dev, str):
-                yield self.json.get("device")
-                break
-            yield dev
+        yield from self.json["device"]
 
     @property
     def links(self):
         """Generator to yield all links in puzzle."""
-        for lnk in self.json.get("link", []):
-            if lnk is None:
-                # TODO: Why would "None" be added as link data?
-                continue
-            if isinstance(lnk, str):
-                yield self.json.get("link")
-                break
-            elif isinstance(lnk, dict):
-                yield lnk
-            else:
-                logging.warning(f"Ignoring invalid link data, {lnk}")
+        yield from self.json["link"]
 
     @property
     def packets(self):
@@ -122,14 +168,9 @@ class Puzzle(ItemBase):
         return self._get_items("packet")
 
     def all_tests(self, hostname=None):
-        tests = []
-        for test in self._get_items("nettest"):
-            if hostname is None:
-                tests.append(test)
-            else:
-                if test.get("shost") == hostname:
-                    tests.append(test)
-        return tests
+        if hostname is None:
+            return list(self._test_index().tests)
+        return list(self._test_index().by_host.get(hostname, ()))
 
     def all_puzzle_IPs(self):
         iplist = list()
@@ -142,7 +183,7 @@ class Puzzle(ItemBase):
         commands = list()
         dev_json = self.device_from_name(hostname)
         if dev_json:
-            dev = device.Device(dev_json)
+            dev = device.Device.shared(dev_json)
             all_tests = dev.all_tests()
         else:
             dev = None
@@ -208,7 +249,27 @@ class Puzzle(ItemBase):
         return commands
 
     def arp_lookup(self, ipaddr):
-        return device.globalArpLookup(ipaddr)
+        """Return the MAC address for the given IP, or None if no device has it."""
+        return self._arp_index()[0].get(packet.justIP(ipaddr))
+
+    def device_name_from_mac(self, mac):
+        """Return the hostname of the device that owns the given MAC, or None."""
+        return self._arp_index()[1].get(mac)
+
+    def broadcast_domain(self, nic_id) -> frozenset:
+        """Return the uniqueidentifiers of the network cards that hear broadcasts sent from the given one.
+        Args: nic_id: str - the uniqueidentifier of a network card
+        returns: a frozenset that includes nic_id, or is empty if the card is on a powered-off device
+        """
+        return self._broadcast_domains().members(nic_id)
+
+    def same_broadcast_domain(self, nic_a, nic_b) -> bool:
+        """Return True if a broadcast from one network card can reach the other.
+        Args: nic_a, nic_b: str - uniqueidentifiers of network cards
+        """
+        domains = self._broadcast_domains()
+        root = domains.find(nic_a)
+        return root is not None and root == domains.find(nic_b)
 
     def delete_packet(self, pkt):
         pkts = self.json.get("packet")
@@ -221,55 +282,33 @@ class Puzzle(ItemBase):
             del self.json["packet"]
 
     def device_from_ip(self, ipaddr):
-        for d in self.devices:
-            if d:
-                for n in d.get("nic"):
-                    conform_json_values(n, "interface")
-                    for iface in n.get("interface"):
-                        if iface.get("myip").get("ip") == ipaddr:
-                            return d
+        return self._arp_index()[2].get(ipaddr)
 
     def device_from_name(self, name):
-        return self._item_by_attrib(self.devices, "hostname", name)
+        return self._lookup("device", "hostname", name)
 
     def device_obj_from_name(self, name):
         return device.Device(self.device_from_name(name))
 
     def device_from_uid(self, uid):
         uid = str(uid)  # ensure not an integer
-        return self._item_by_attrib(self.devices, "uniqueidentifier", uid)
+        return self._lookup("device", "uniqueidentifier", uid)
 
     def device_is_critical(self, name):
-        test_devices = set()
-        for test in self.all_tests():
-            for h in ("shost", "dhost"):
-                host = test.get(h)
-                if host:
-                    test_devices.add(host)
-        return name in test_devices
+        return name in self._test_index().critical
 
     def device_is_frozen(self, thost):
-        for test in self.all_tests():
-            if (
-                test.get("shost") == thost.get("hostname")
-                and test.get("thetest") == "DeviceIsFrozen"
-            ):
-                if test.get("completed"):
-                    return False
-                else:
-                    return True
-        return False
+        test = self._test_index().find_for_host(thost.get("hostname"), "DeviceIsFrozen")
+        if test is None or test.get("completed"):
+            return False
+        return True
 
     def has_test_been_completed(self, shost, dhost, whattocheck):
-        for test in self.all_tests():
-            if (
-                test.get("shost") == shost
-                and test.get("dhost") == dhost
-                and test.get("thetest") == whattocheck
-            ):
-                # the test matches, return true only if 'completed' is set to true
-                return test.get("completed", False)
-        return False
+        test = self._test_index().find(shost, dhost, whattocheck)
+        if test is None:
+            return False
+        # the test matches, return true only if 'completed' is set to true
+        return test.get("completed", False)
 
     def ClearPingTests(self):
         self.json["pingtests"] = []
@@ -339,21 +378,27 @@ class Puzzle(ItemBase):
                         # Now, check to see if the source is in the destination network
                         if one_d_ip != one_s_ip and one_s_ip in one_d_ip.network:
                             # It is true.
-                            test["completed"] = True
-                            test["acknowledged"] = False
-                            test["message"] = (
-                                f"{shost.get('hostname')} has local IP to {dhost.get('hostname')}"
+                            self._test_index().complete(
+                                test,
+                                f"{shost.get('hostname')} has local IP to {dhost.get('hostname')}",
                             )
 
     def is_solved(self):
         """Report back to see if all the tests have been completed."""
-        for onetest in self.all_tests():
-            if onetest.get("thetest", "").startswith("Lock"):
-                # These do not count as unfinished tests
-                continue
-            if not onetest.get("completed", False):
-                return False
-        return True
+        return self._test_index().outstanding == 0
+
+    def take_unacknowledged_tests(self):
+        """Return the tests completed since the last call, oldest first; the caller acknowledges them."""
+        queue = self._test_index().unacknowledged
+        tests = list(queue)
+        queue.clear()
+        return tests
+
+    def reopen_test(self, test):
+        """Mark a completed test as not done after all.
+        Args: test: dict - the test record
+        """
+        self._test_index().reopen(test)
 
     def item_from_uid(self, uid):
         """Return the item matching the ID.  Could be a device, a link, or a nic"""
@@ -370,19 +415,7 @@ class Puzzle(ItemBase):
 
     def item_is_locked(self, shost, whattocheck, dhost=None):
         # logging.debug(f"item_is_locked: {shost=}; {whattocheck=}; {dhost=}")
-        for test in self.all_tests(shost):
-            # logging.debug(f"item_is_locked: {test=}")
-            thetest = test.get("thetest")
-            if thetest == "LockAll":
-                if whattocheck != "LockLocation":
-                    return True
-            elif thetest == whattocheck:
-                if whattocheck in ("LockLocation", "LockVlanNames", "LockVLANsOnHost"):
-                    return True
-                if dhost and test.get("dhost") == dhost:
-                    # if the source (hostname) and dest (, ping_desthostname, nic, etc) also match.
-                    return True
-        return False
+        return self._test_index().is_locked(shost, whattocheck, dhost)
 
     def item_can_be_moved_here(self, shost, newx, newy):
         # logging.debug(f"item_is_locked: {shost=}; {whattocheck=}; {dhost=}")
@@ -464,7 +497,7 @@ class Puzzle(ItemBase):
 
     def item_blows_up(self, shost):
         print(f"Testing item blows up for {shost}")
-        for test in self.all_tests(shost):
+        for test in self._test_index().by_host.get(shost, ()):
             print(f"testing {test}")
             thetest = test.get("thetest")
             if thetest == "DeviceBlowsUpWithPower" and not test.get("completed", False):
@@ -472,7 +505,7 @@ class Puzzle(ItemBase):
         return False
 
     def item_needs_ups(self, shost):
-        for test in self.all_tests(shost):
+        for test in self._test_index().by_host.get(shost, ()):
             thetest = test.get("thetest")
             if thetest == "DeviceNeedsUPS" and not test.get("completed", False):
                 return True
@@ -513,29 +546,47 @@ class Puzzle(ItemBase):
         return None
 
     def link_from_name(self, name):
-        return self._item_by_attrib(self.links, "hostname", name)
+        return self._lookup("link", "hostname", name)
 
     def link_from_uid(self, uid):
-        return self._item_by_attrib(self.links, "uniqueidentifier", uid)
+        return self._lookup("link", "uniqueidentifier", uid)
+
+    def link_from_nic_id(self, nicid):
+        """Return the link plugged into the network card with the given id, or None."""
+        return self._lookup("link", "nicid", nicid)
+
+    def link_from_nic_name(self, hostname, nicname):
+        """Return the link whose end names the given device and network card, or None."""
+        return self._lookup("link", "end", (hostname, nicname))
+
+    def nic_peer(self, nicid):
+        """Find what is on the other end of the link plugged into a network card
+        Args: nicid: str - the unique id of the nic on this end of the link
+        returns: a tuple of (nic, device) json for the far end, or None if the nic has no link
+        """
+        link = self.link_from_nic_id(nicid)
+        if link is None:
+            return None
+        far_end = link["DstNic"] if link["SrcNic"]["nicid"] == nicid else link["SrcNic"]
+        return (
+            self.nic_from_uid(far_end.get("nicid")),
+            self.device_from_uid(far_end.get("hostid")),
+        )
 
     def mark_test_as_completed(self, shost, dhost, whattocheck, message):
-        for onetest in self.all_tests():
-            if (
-                onetest.get("shost") == shost
-                and onetest.get("dhost") == dhost
-                and onetest.get("thetest") == whattocheck
-            ) or (
-                onetest.get("dhost") == dhost
-                and onetest.get("thetest") == whattocheck
-                and whattocheck == "DeviceIsFrozen"
-            ):
-                # if the test has never been completed
-                if not onetest.get("completed", False):
-                    onetest["completed"] = True
-                    onetest["acknowledged"] = False
-                    onetest["message"] = message
-                    # print(f"Debug: Marking as done: {onetest.get('shost')} {onetest.get('dhost')} {onetest.get('thetest')}")
-                return True  # no need to continue looping through other tests
+        index = self._test_index()
+        if whattocheck == "DeviceIsFrozen":
+            # Any frozen test aimed at the host will do, whichever host it is on.
+            onetest = index.find_for_dhost(dhost, whattocheck)
+        else:
+            onetest = index.find(shost, dhost, whattocheck)
+        if onetest is None:
+            return None
+        # if the test has never been completed
+        if not onetest.get("completed", False):
+            index.complete(onetest, message)
+            # print(f"Debug: Marking as done: {onetest.get('shost')} {onetest.get('dhost')} {onetest.get('thetest')}")
+        return True  # no need to continue looping through other tests
 
     def nic_from_uid(self, uid):
         """find the network card from the id
@@ -544,12 +595,7 @@ class Puzzle(ItemBase):
             Each component on the network has a unique ID.  PCs can change names, so we do not assume host-names are unique.
             Thus, for a network link (ethernet cable, wireless, etc) to know what two devices it is connecting, we use the ID
         """
-        for d in self.devices:
-            if d:
-                item = self._item_by_attrib(d.get("nic"), "uniqueidentifier", uid)
-                if item:
-                    return item
-        return None
+        return self._lookup("nic", "uniqueidentifier", uid)
 
     def packets_need_processing(self):
         """Determine if we should continue to loop through packets
@@ -563,19 +609,81 @@ class Puzzle(ItemBase):
             session.packetstorm = True
         return len(self.packets) > 0
 
-    def process_packets(self, killSeconds: int = 8, tick_pct: float = 10):
+    def process_next_packet_event(
+        self, *, tick_pct: float = 10, lifetime: int = PACKET_LIFETIME
+    ):
+        """Run ticks until one that changes something more than packet positions.
+        This gives the same results as calling process_packets once per tick, but
+        the ticks where packets only move along their links are skipped over.
+        Args:
+            tick_pct - how far along its link each packet moves per tick, in percent
+            lifetime - how far a packet can travel before it is killed, in percent of a link
+        """
+        ticks = self._ticks_until_packet_event(tick_pct, lifetime)
+        self._move_packets(tick_pct, ticks - 1)
+        self.process_packets(tick_pct=tick_pct, lifetime=lifetime)
+
+    def _ticks_until_packet_event(self, tick_pct, lifetime):
+        """Return the number of ticks until some packet arrives, dies or times out."""
+        ticks = None
+        for pkt in self.packets:
+            if pkt.status == "tunneled":
+                continue
+            if pkt.status in ("done", "dropped", "failed") or pkt.packet_location == "":
+                return 1
+            remaining = [lifetime - (self.sim_time - pkt.starttime)]
+            current_link = pkt.get_current_link()
+            if current_link is not None:
+                remaining.append(100 - pkt.distance)
+                if current_link.linktype == "broken" and pkt.distance <= 50:
+                    remaining.append(50 - pkt.distance)
+            # Something happens on the first tick that takes the packet past the
+            # remaining distance.
+            pkt_ticks = math.floor(min(remaining) / tick_pct) + 1
+            if ticks is None or pkt_ticks < ticks:
+                ticks = pkt_ticks
+        if ticks is None:
+            return 1
+        return max(ticks, 1)
+
+    def _move_packets(self, tick_pct, ticks):
+        """Move the packets along their links for some ticks, without any of them arriving.
+        No packet changes links during these ticks, so each one's link is only looked up once.
+        """
+        links = {id(pkt): pkt.get_current_link() for pkt in self.packets}
+        for _ in range(ticks):
+            self.sim_time += tick_pct
+            for pkt in self.packets:
+                if pkt.status == "tunneled":
+                    continue
+                current_link = links.get(id(pkt))
+                if current_link is not None:
+                    pkt.apply_possible_damage(tick_pct, current_link)
+                    pkt.distance += tick_pct
+                if pkt.status in ("done", "dropped", "failed"):
+                    pkt.remove_from_packet_list()
+
+    def process_packets(
+        self,
+        killSeconds: float = PACKET_LIFETIME_SECONDS,
+        *,
+        tick_pct: float = 10,
+        lifetime: int | None = None,
+    ):
         """
         Loop through all packets, moving them along through the system
-        Args: killseconds - the number of seconds to go before killing the packets.
+        Args:
+            killSeconds - the number of seconds to go before killing the packets,
+                counted as the distance a GUI packet covers in that time
+            tick_pct - how far along its link each packet moves, in percent
+            lifetime - how far a packet can travel before it is killed, in percent
+                of a link; overrides killSeconds
         """
-        # NOTE: If killSeconds is too high (~20), then Level0_NetworkLoop seems
-        # to run forever (~40 sec) before the packets time out. However, if it's
-        # set too low (~5), then Level0_Traceroute fails because the packet
-        # traveling the farthest on the network (6 segments) times out before
-        # arriving at its destination. Therefore, 8 has been chosen for now.
-        killMilliseconds = killSeconds * 1000
-        # here we loop through all packets and process them
-        curtime = int(time.time() * 1000)
+        if lifetime is None:
+            lifetime = PACKET_LIFETIME * killSeconds / PACKET_LIFETIME_SECONDS
+        # NOTE: Timeouts use the simulation clock rather than the wall clock, so
+        # the results do not depend on how fast the computer runs the ticks.
+        self.sim_time += tick_pct
         counter = 0
         # logging.debug("Packet: Starting packetlist loop.")
         for pkt in self.packets:
@@ -591,7 +699,7 @@ class Puzzle(ItemBase):
             # logging.debug(f"Packet: On link: {current_link}, {pkt.status=}")
             if current_link is not None:
                 # the packet is traversing a link
-                pkt.apply_possible_damage(tick_pct)
+                pkt.apply_possible_damage(tick_pct, current_link)
                 pkt.distance += tick_pct
                 # logging.debug(
                 #     f"Packet: on link {current_link.hostname} at {pkt.distance}%"
@@ -615,7 +723,7 @@ class Puzzle(ItemBase):
                     dev_data = session.puzzle.device_from_uid(dest_nic.my_id.host_id)
                     if dev_data is None:
                         raise Exception(f"Device not found for NIC: {dest_nic.name}")
-                    dst_dev = device.Device(dev_data)
+                    dst_dev = device.Device.shared(dev_data)
                     logging.debug(f"Packet: Arrived at: {dst_dev.hostname}:{dest_nic}")
                     dst_dev.accept_packet(pkt, dest_nic)
 
@@ -623,8 +731,8 @@ class Puzzle(ItemBase):
                 pkt.status = "done"
 
             # If the packet has been going too long.  Kill it.
-            if curtime - pkt.starttime > killMilliseconds:
-                # over 20 seconds have passed.  Kill the packet
+            if self.sim_time - pkt.starttime > lifetime:
+                # it has traveled too far.  Kill the packet
                 pkt.status = "failed"
                 pkt.statusmessage = "Packet timed out"
                 logging.warning(f"packet killed {pkt.json}")
@@ -655,7 +763,6 @@ class Puzzle(ItemBase):
     def set_all_device_nic_macs(self):
         for oneDevice in self.devices:
             if oneDevice:
-                conform_json_values(oneDevice, "nic")
                 for oneNic in oneDevice["nic"]:
                     oneNic = Nic(oneNic).ensure_mac()
 
@@ -680,6 +787,8 @@ class Puzzle(ItemBase):
         elif isinstance(self.json.get("device"), list):
             idx = self.json["device"].index(existing_device)
             del self.json["device"][idx]
+        self.invalidate("arp", "device", "nic", "fib", "damage", "wireless", "domains")
+        self.mark_wireless_dirty()
         return True
 
     def delete_link_by_hostname(self, hostname):
@@ -695,6 +804,10 @@ class Puzzle(ItemBase):
             # Delete item from list.
             idx = self.json["link"].index(existing_link)
             del self.json["link"][idx]
+        self.invalidate("link", "domains")
+        self.mark_wireless_dirty(
+            existing_link["SrcNic"]["hostname"], existing_link["DstNic"]["hostname"]
+        )
         return True
 
     def delete_item(self, itemToDelete: str):
@@ -786,6 +899,9 @@ class Puzzle(ItemBase):
             newnic["usesdhcp"] = "True"
         Nic(newnic).ensure_mac()
         thedevicejson["nic"].append(newnic)
+        self._add_to_index("nic", newnic)
+        self.invalidate("arp", "fib", "wireless", "domains")
+        self.mark_wireless_dirty(thedevice.hostname)
         return newnic
 
     def createDevice(self, args):
@@ -863,6 +979,9 @@ class Puzzle(ItemBase):
                 self.createNIC(newdevice, "wan")
 
         self.json["device"].append(newdevice)
+        self._add_to_index("device", newdevice)
+        self.invalidate("damage", "wireless")
+        self.mark_wireless_dirty(newdevicename)
         session.print(f"Creating new device: {newdevicename}")
 
     def createLink(self, args, linktype="normal") -> bool:
@@ -954,8 +1073,11 @@ class Puzzle(ItemBase):
             newlink["uniqueidentifier"] = session.puzzle.issueUniqueIdentifier()
             newlink["SrcNic"] = copy.copy(snic.my_id.json)
             newlink["DstNic"] = copy.copy(dnic.my_id.json)
-            conform_json_values(self.json, "link")
             self.json["link"].append(newlink)
+            self._add_to_index("link", newlink)
+            if "domains" in self._cache:
+                self._join_link_ends(self._cache["domains"], newlink)
+            self.mark_wireless_dirty(sdevicename, ddevicename)
             session.print(f"Created link: {newlink['hostname']}")
             device.mark_test_as_completed(
                 sdevicename,
@@ -978,10 +1100,376 @@ class Puzzle(ItemBase):
         # logging.debug("Doing AutoJoinWirelsss")
         for onedevice in self.devices:
             device.Device(onedevice).autojoin_wireless()
+        # Links made or dropped while joining do not need another pass.
+        self._wireless_dirty = set()
+
+    def mark_wireless_dirty(self, *hostnames):
+        """Flag devices whose wireless links may need to change.
+        Args: hostnames: str - devices that moved, changed power, ssid, key, nics
+            or links; with no hostnames, every device is flagged
+        """
+        if not hostnames:
+            self._wireless_dirty = None
+        elif self._wireless_dirty is not None:
+            self._wireless_dirty.update(hostnames)
+
+    def rejoin_wireless(self):
+        """Re-run wireless auto-join for the flagged devices and the wireless
+        clients they can affect, in the same order AutoJoinAllWireless uses."""
+        if self._wireless_dirty is None:
+            return self.AutoJoinAllWireless()
+        if not self._wireless_dirty:
+            return
+        logging.debug(f"Rejoining wireless around: {sorted(self._wireless_dirty)}")
+        affected = self._wireless_affected(self._wireless_dirty)
+        for onedevice in self.devices:
+            if onedevice.get("hostname") in affected:
+                device.Device(onedevice).autojoin_wireless()
+        self._wireless_dirty = set()
+
+    def _wireless_affected(self, hostnames):
+        """Work out which devices to re-run auto-join on.
+        Args: hostnames: set - flagged device hostnames
+        returns: a set of hostnames; the flagged devices, whatever they are linked
+            to, and every client in range of an access point among those
+        """
+        affected = set(hostnames)
+        for hostname in hostnames:
+            dev_json = self.device_from_name(hostname)
+            if dev_json is None:
+                continue
+            for onenic in device.Device.shared(dev_json).nics:
+                onelink = self.link_from_nic_id(onenic.my_id.nic_id)
+                if onelink is None:
+                    continue
+                ends = {onelink["SrcNic"]["hostname"], onelink["DstNic"]["hostname"]}
+                # Some puzzles reuse nic ids, so check the link really is this device's.
+                if hostname in ends:
+                    affected.update(ends)
+
+        cell_size, _, clients = self._wireless_index()
+        for hostname in list(affected):
+            dev_json = self.device_from_name(hostname)
+            if dev_json is None:
+                continue
+            ap = device.Device.shared(dev_json)
+            if not any(onenic.type == "wport" for onenic in ap.nics):
+                continue
+            ax, ay = ap.location
+            col = ax // cell_size
+            row = ay // cell_size
+            for dcol in (-1, 0, 1):
+                for drow in (-1, 0, 1):
+                    for cx, cy, client in clients.get((col + dcol, row + drow), []):
+                        if (
+                            get_puzzle_distance(cx, cy, ax, ay)
+                            <= session.WirelessReconnectDistance
+                        ):
+                            affected.add(client)
+        return affected
 
     def ClearAllConnectionEntries(self):
         for onedevice in self.devices:
-            device.Device(onedevice).ClearIPConnections()
+            device.Device.shared(onedevice).ClearIPConnections()
+
+    def damage_profile(self, pkt, lnk=None):
+        """Work out what damages a packet on its current link, and where.
+        Args:
+            pkt: packet.Packet - a packet traveling on a link
+            lnk: link.Link - the packet's current link, if the caller already has it
+        returns: a tuple of ([(device, {% distances it damages the packet at})], {% distances
+            where a wireless signal is too weak}), or None if the link ends are unknown
+        """
+        if lnk is None:
+            lnk = pkt.get_current_link()
+        key = (lnk.uniqueidentifier, pkt.direction, lnk.linktype)
+        profiles = self._cache.setdefault("damage", {})
+        if key not in profiles:
+            profiles[key] = self._build_damage_profile(
+                lnk, pkt.get_current_link_endpoint_devices()
+            )
+        return profiles[key]
+
+    def wireless_access_points_near(self, dev, client_nic):
+        """Find the access points a wireless nic could join.
+        Args:
+            dev: device.Device - the device that has the wireless nic
+            client_nic: nic.Nic - the wireless nic that wants to join
+        returns: a list of (device json, [matching wport nic json]) within WirelessReconnectDistance,
+            in the same order as the puzzle's devices
+        """
+        cell_size, grid, _ = self._wireless_index()
+        sx, sy = dev.location
+        col = sx // cell_size
+        row = sy // cell_size
+        nearby = []
+        for dcol in (-1, 0, 1):
+            for drow in (-1, 0, 1):
+                cell = grid.get((col + dcol, row + drow), {})
+                for entry in cell.get((client_nic.ssid, client_nic.encryption_key), []):
+                    dx, dy = entry[2]
+                    distance = get_puzzle_distance(sx, sy, dx, dy)
+                    if distance <= session.WirelessReconnectDistance:
+                        nearby.append(entry)
+        nearby.sort(key=lambda entry: entry[0])
+        return [(ap_json, wport_nics) for _, ap_json, _, wport_nics in nearby]
+
+    def forwarding_table(self, dev):
+        """Return the compiled routes for a device, building them if needed.
+        Args: dev: device.Device - the device to route packets for
+        """
+        tables = self._cache.setdefault("fib", {})
+        entry = tables.get(dev.uniqueidentifier)
+        if entry is None or entry[0] is not dev.json:
+            interfaces = []
+            for onenic in dev.nics:
+                if onenic.type != "port":  # Ports have no IP address
+                    interfaces.extend(onenic.interfaces_data)
+            gateway = (dev.json.get("gateway") or {}).get("ip", "")
+            entry = (dev.json, ForwardingTable(dev.routes, interfaces, gateway))
+            tables[dev.uniqueidentifier] = entry
+        return entry[1]
+
+    def firewall(self, dev):
+        """Return the compiled firewall rules for a device, building them if needed.
+        Code that edits the rule list in place calls Device.firewall_changed().
+        Args: dev: device.Device - the device whose rules are checked
+        """
+        compiled = self._cache.setdefault("firewall", {})
+        entry = compiled.get(dev.uniqueidentifier)
+        rules = dev.firewall_rules
+        if entry is None or entry.rules is not rules:
+            hits = self._firewall_hits.setdefault(dev.uniqueidentifier, Counter())
+            entry = device.FirewallRules(rules, hits)
+            compiled[dev.uniqueidentifier] = entry
+        return entry
+
+    def connection_table(self, dev):
+        """Return the index of a device's NAT records, building it if needed.
+        Args: dev: device.Device - the device whose connections are tracked
+        """
+        table = self._connection_tables.get(dev.uniqueidentifier)
+        records = dev.ip_connections
+        if table is None or table.records is not records:
+            old_table = table
+            table = device.ConnectionTable(records, self.sim_time, CONNECTION_LIFETIME)
+            if old_table is not None:
+                table.matched = old_table.matched
+                table.unmatched = old_table.unmatched
+                table.evicted = old_table.evicted
+            self._connection_tables[dev.uniqueidentifier] = table
+        return table
+
+    def wrapper(self, cls, json_data):
+        """Return the one wrapper object kept for a JSON record, making it if needed.
+        The wrappers go with the rest of the cache, e.g. on undo and after every command.
+        Args:
+            cls: the ItemBase class to wrap the record in, e.g. device.Device
+            json_data: dict - the record
+        """
+        wrappers = self._cache.setdefault("wrappers", {})
+        key = (cls, id(json_data))
+        item = wrappers.get(key)
+        if item is None or item.json is not json_data:
+            item = cls(json_data)
+            wrappers[key] = item
+        return item
+
+    def invalidate(self, *names):
+        """Drop cached lookups so they are rebuilt from the JSON data when next used.
+        Args: names: the cache names to drop, e.g. "arp".  Drops all of them if none are given.
+        """
+        if not names:
+            self._cache.clear()
+        for name in names:
+            self._cache.pop(name, None)
+
+    def _test_index(self):
+        """Return the NetTestIndex of the puzzle's tests, building it if needed.
+        Commands never edit the tests, so it is only rebuilt when the whole cache
+        is dropped: on loading a puzzle and on undo/redo.
+        """
+        if "tests" not in self._cache:
+            self._cache["tests"] = NetTestIndex(self._get_items("nettest"))
+        return self._cache["tests"]
+
+    def _arp_index(self):
+        """Return (IP -> MAC, MAC -> hostname, IP -> device) lookups for every interface in the puzzle."""
+        if "arp" not in self._cache:
+            mac_by_ip = {}
+            host_by_mac = {}
+            device_by_ip = {}
+            for dev in self.devices:
+                if not dev:
+                    continue
+                for onemac in device.Device.shared(dev).mac_list():
+                    # The first device found with a given IP wins, as it always has.
+                    mac_by_ip.setdefault(packet.justIP(onemac["ip"]), onemac["mac"])
+                    host_by_mac.setdefault(onemac["mac"], dev.get("hostname"))
+                for n in dev.get("nic"):
+                    for iface in n.get("interface"):
+                        device_by_ip.setdefault(iface.get("myip").get("ip"), dev)
+            self._cache["arp"] = (mac_by_ip, host_by_mac, device_by_ip)
+        return self._cache["arp"]
+
+    def _index(self, item_type: str) -> dict:
+        """Return {attribute: {value: item}} lookups for all items of the given type.
+        Args: item_type: "device", "link" or "nic"
+        """
+        if item_type not in self._cache:
+            self._cache[item_type] = {attrib: {} for attrib in INDEXED_ATTRIBS}
+            if item_type == "link":
+                self._cache[item_type]["nicid"] = {}
+                self._cache[item_type]["end"] = {}
+            if item_type == "nic":
+                items = (n for d in self.devices if d for n in d.get("nic", []))
+            else:
+                items = getattr(self, f"{item_type}s")
+            for item in items:
+                self._add_to_index(item_type, item)
+        return self._cache[item_type]
+
+    def _add_to_index(self, item_type: str, item: dict):
+        """Add a newly-created item to the lookups, if they have been built."""
+        if item_type not in self._cache or not isinstance(item, dict):
+            return
+        index = self._cache[item_type]
+        # The first item found wins, the same as a linear search would.
+        for attrib in INDEXED_ATTRIBS:
+            index[attrib].setdefault(item.get(attrib), item)
+        if item_type == "link":
+            # Links can also be found from the network card at either end, by
+            # its id or by its device and card names.
+            for end in ("SrcNic", "DstNic"):
+                end_nic = item.get(end, {})
+                nicid = end_nic.get("nicid")
+                if nicid is not None:
+                    index["nicid"].setdefault(nicid, item)
+                names = (end_nic.get("hostname"), end_nic.get("nicname"))
+                index["end"].setdefault(names, item)
+
+    def _lookup(self, item_type: str, attrib: str, value: str) -> dict | None:
+        try:
+            return self._index(item_type)[attrib].get(value)
+        except TypeError:
+            # Unhashable values cannot match anything.
+            return None
+
+    def _wireless_index(self):
+        """Return (cell size, {grid cell: {(ssid, key): [access point entries]}},
+        {grid cell: [(x, y, hostname)]}) for the puzzle's wireless forwarders and
+        the devices with a wireless card."""
+        # Cells are as wide as the reconnect distance, so anything in range of a
+        # point is in its cell or one of the eight around it.
+        cell_size = int(session.WirelessReconnectDistance * 5) or 1
+        if self._cache.get("wireless", (None,))[0] != cell_size:
+            grid = {}
+            clients = {}
+            for order, ap_json in enumerate(self.devices):
+                ap = device.Device.shared(ap_json)
+                if any(onenic.type == "wlan" for onenic in ap.nics):
+                    x, y = ap.location
+                    clients.setdefault((x // cell_size, y // cell_size), []).append(
+                        (x, y, ap.hostname)
+                    )
+                if not ap.is_wireless_forwarder:
+                    continue
+                wport_nics = {}
+                for dstnic in ap.nics_data:
+                    t_dstnic = Nic.shared(dstnic)
+                    if t_dstnic.type == "wport":
+                        key = (t_dstnic.ssid, t_dstnic.encryption_key)
+                        wport_nics.setdefault(key, []).append(dstnic)
+                if not wport_nics:
+                    continue
+                x, y = ap.location
+                cell = grid.setdefault((x // cell_size, y // cell_size), {})
+                for key, nics in wport_nics.items():
+                    cell.setdefault(key, []).append((order, ap_json, (x, y), nics))
+            self._cache["wireless"] = (cell_size, grid, clients)
+        return self._cache["wireless"]
+
+    def _broadcast_domains(self):
+        """Return the BroadcastDomains for every network card on a powered-on device."""
+        if "domains" not in self._cache:
+            domains = BroadcastDomains()
+            for dev_json in self.devices:
+                dev = device.Device.shared(dev_json)
+                if not dev_json or not dev.powered_on:
+                    continue
+                bridges_all = dev.forwards_packets and dev.mytype != "wrouter"
+                bridged = []
+                for onenic in dev.nics:
+                    if onenic.type == "lo":
+                        continue
+                    domains.add(onenic.uniqueidentifier)
+                    if not dev.forwards_packets:
+                        continue
+                    if onenic.type in BRIDGED_NIC_TYPES or (
+                        bridges_all and onenic.type not in ("vpn", "wan")
+                    ):
+                        bridged.append(onenic.uniqueidentifier)
+                for nic_id in bridged[1:]:
+                    domains.union(bridged[0], nic_id)
+            for lnk in self.links:
+                self._join_link_ends(domains, lnk)
+            self._cache["domains"] = domains
+        return self._cache["domains"]
+
+    def _join_link_ends(self, domains, link_data):
+        """Join the domains at either end of a link, unless it is broken or an end is switched off."""
+        if not isinstance(link_data, dict) or link_data.get("linktype") == "broken":
+            return
+        src_id = link_data.get("SrcNic", {}).get("nicid")
+        dst_id = link_data.get("DstNic", {}).get("nicid")
+        if domains.find(src_id) is not None and domains.find(dst_id) is not None:
+            domains.union(src_id, dst_id)
+
+    def _build_damage_profile(self, lnk, devices):
+        if devices is None or not isinstance(devices, tuple):
+            return None
+        src_device, dest_device = devices
+        sx, sy = src_device.location
+        all_pcts = range(101)
+        all_points = packet.link_points(src_device, dest_device, all_pcts)
+
+        # List damage-causing devices in puzzle.
+        risky_devices = []
+        for dev_json in self.devices:
+            dev = device.Device.shared(dev_json)
+            if dev.mytype == "tree" and lnk.linktype == "wireless":
+                damage_distance = 9  # it needs to hit the tree.
+            elif dev.mytype == "microwave" and lnk.linktype == "wireless":
+                damage_distance = 43
+            elif dev.mytype == "fluorescent" and lnk.linktype != "wireless":
+                damage_distance = 43
+            else:
+                continue
+            # calculate the centerpoint
+            # all devices in EduNetworkBuilder were 100 size
+            halfsize = int(dev.size / 2)
+            dx, dy = dev.location
+            dx += halfsize
+            dy += halfsize
+            # NOTE: It seems unnecessary (or possibly erroneous) to convert the
+            # distance into an int, but already-designed puzzles depend on it.
+            damaging_pcts = {
+                dist_pct
+                for dist_pct, (px, py) in zip(all_pcts, all_points)
+                if int(get_puzzle_distance(px, py, dx, dy)) <= damage_distance
+            }
+            if damaging_pcts:
+                risky_devices.append((dev, damaging_pcts))
+
+        weak_signal_pcts = set()
+        if lnk.linktype == "wireless":
+            weak_signal_pcts = {
+                dist_pct
+                for dist_pct, (px, py) in zip(all_pcts, all_points)
+                if int(get_puzzle_distance(px, py, sx, sy))
+                >= session.WirelessFailureDistance
+            }
+        return (risky_devices, weak_signal_pcts)
 
     def _get_items(self, item_type: str):
         """
@@ -1058,6 +1546,37 @@ class PuzzleTest:
         return self.json.get("shost")
 
 
+def normalize_puzzle(network: dict) -> dict:
+    """Put a puzzle's data into the one shape the rest of the code expects.
+    The puzzle files store a list with one item as just the item, and leave some
+    fields out or null; fixing that once here saves checking on every lookup.
+    Args: network: dict - the puzzle's "Network" data, changed in place
+    returns: the same data
+    """
+    for key in ("device", "link", "nettest"):
+        conform_json_values(network, key)
+        items = network[key]
+        if not all(isinstance(item, dict) for item in items):
+            for item in items:
+                if not isinstance(item, dict):
+                    logging.warning(f"Ignoring invalid {key} data, {item}")
+            network[key] = [item for item in items if isinstance(item, dict)]
+    for onedevice in network["device"]:
+        conform_json_values(onedevice, "nic")
+        for onenic in onedevice["nic"]:
+            conform_json_values(onenic, "interface")
+            if not onenic.get("nictype"):
+                onenic["nictype"] = ["", ""]
+            if onenic.get("encryptionkey") is None:
+                # The GUI needs a string.
+                onenic["encryptionkey"] = ""
+            if onenic.get("usesdhcp") is None:
+                onenic["usesdhcp"] = "false"
+            if onenic["nictype"][0] == "vpn" and onenic.get("tunnelendpoint") is None:
+                onenic["tunnelendpoint"] = {"ip": ""}
+    return network
+
+
 def read_json_file(file_path):
     """
     Reads a JSON file and returns the data as a Python dictionary.
@@ -1091,10 +1610,7 @@ def matches_filter(name: str, pattern: str | None) -> bool:
 
 def sort_session_puzzles():
     session.puzzlelist.sort(
-        key=lambda x: (
-            Version(x["EduNetworkBuilder"]["Network"]["level"]),
-            Version(x["EduNetworkBuilder"]["Network"]["sortorder"]),
-        )
+        key=lambda x: (Version(x["level"]), Version(x["sortorder"]))
     )
 
 
@@ -1102,7 +1618,7 @@ def filter_items(items: list, pattern: str, json_files: bool = False) -> list:
     filtered_items = []
     for item in items:
         if not json_files:
-            name = item["EduNetworkBuilder"]["Network"]["name"]
+            name = item["name"]
         else:
             name = re.sub(r"\.json", "", item)
         if matches_filter(name, pattern):
@@ -1123,18 +1639,68 @@ def listPuzzles(regex_pattern: str = None):
     return filter_items(session.puzzlelist, regex_pattern)
 
 
+def catalog_entry(name: str, network: dict) -> dict:
+    """Return the catalog entry for a puzzle: what is needed to list it without
+    loading it.
+    Args:
+        name: str - the puzzle name, which is its file name without ".json"
+        network: dict - the puzzle's "Network" JSON data
+    """
+    tags = network.get("tag")
+    if tags is None:
+        tags = []
+    elif not isinstance(tags, list):
+        tags = [tags]
+    return {
+        "name": name,
+        "level": str(network.get("level", "0")),
+        "sortorder": str(network.get("sortorder", "0")),
+        "title": network.get("en_title", ""),
+        "tags": tags,
+    }
+
+
+def build_catalog() -> list:
+    """Read every puzzle file and return the sorted catalog entries for them."""
+    puzzles_dir = DATA_DIR / "resources" / "puzzles"
+    catalog = []
+    for one in listPuzzlesFromDisk("Level.*"):
+        oneentry = read_json_file(str(puzzles_dir / f"{one}.json"))
+        if oneentry is not None:
+            catalog.append(catalog_entry(one, oneentry["EduNetworkBuilder"]["Network"]))
+    catalog.sort(key=lambda x: (Version(x["level"]), Version(x["sortorder"])))
+    return catalog
+
+
+def load_catalog() -> list:
+    """Return the puzzle catalog, using the generated catalog file if it lists
+    exactly the puzzles on disk.  Otherwise every puzzle file is read instead.
+    """
+    catalog = read_json_file(str(CATALOG_FILE)) if CATALOG_FILE.is_file() else None
+    if catalog is not None:
+        names = {entry.get("name") for entry in catalog}
+        if names == set(listPuzzlesFromDisk("Level.*")):
+            return catalog
+        logging.warning(f"{CATALOG_FILE.name} is out of date; reading puzzle files")
+    return build_catalog()
+
+
+def write_catalog(file_path=None):
+    """Regenerate the catalog file from the puzzle files.
+    Args:
+        file_path: Path - where to write it; defaults to the packaged catalog file
+    """
+    if file_path is None:
+        file_path = CATALOG_FILE
+    with open(file_path, "w") as file:
+        json.dump(build_catalog(), file, indent=2)
+        file.write("\n")
+
+
 def readPuzzle():
-    """Read in the puzzles from the various .json files"""
+    """Read in the puzzle catalog, which lists the puzzles without loading them"""
     if len(session.puzzlelist) == 0:
-        allfiles = listPuzzlesFromDisk("Level.*")
-        puzzles_dir = DATA_DIR / "resources" / "puzzles"
-        for one in allfiles:
-            # We stripped off the ".json" from the name, so we need to add it back
-            file_path = str(puzzles_dir / f"{one}.json")
-            oneentry = read_json_file(file_path)
-            oneentry["EduNetworkBuilder"]["Network"]["name"] = one
-            session.puzzlelist.append(oneentry)
-            # print("loading: " + one)
+        session.puzzlelist.extend(load_catalog())
         sort_session_puzzles()
         session.undolist = (
             list()
@@ -1144,6 +1710,77 @@ def readPuzzle():
         )  # get rid of redo history; it would not apply to the new puzzle
 
 
+def read_puzzle_data(name: str):
+    """Return a single puzzle's normalized "Network" JSON data, or None.
+    The data comes from the puzzle cache when the file has not changed since
+    it was cached; otherwise the file is parsed and the cache is refreshed.
+    Args:
+        name: str - the puzzle name, which is its file name without ".json"
+    """
+    file_path = DATA_DIR / "resources" / "puzzles" / f"{name}.json"
+    try:
+        source = file_path.read_bytes()
+    except FileNotFoundError:
+        logging.error(f"File not found: {file_path}")
+        return None
+    cache_path = PUZZLE_CACHE_DIR / f"{name}.marshal"
+    cache_key = (
+        __version__,
+        NORMALIZE_VERSION,
+        hashlib.sha256(source).hexdigest(),
+    )
+    network = read_cached_puzzle(cache_path, cache_key)
+    if network is not None:
+        return network
+
+    try:
+        oneentry = json.loads(source)
+    except json.JSONDecodeError:
+        logging.error(f"Invalid JSON format in: {file_path}")
+        return None
+    network = oneentry["EduNetworkBuilder"]["Network"]
+    network["name"] = name
+    normalize_puzzle(network)
+    write_cached_puzzle(cache_path, cache_key, network)
+    return network
+
+
+def read_cached_puzzle(cache_path, cache_key):
+    """Return the cached puzzle data if it was stored under `cache_key`, or None.
+    Args:
+        cache_path: Path - the cache file
+        cache_key: tuple - the app and normalizer versions and the puzzle file's hash
+    """
+    try:
+        # Loading from bytes is much faster than marshal.load() on a file.
+        stored_key, network = marshal.loads(cache_path.read_bytes())
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        logging.warning(f"Ignoring unreadable puzzle cache {cache_path}: {e}")
+        return None
+    if stored_key != cache_key:
+        return None
+    return network
+
+
+def write_cached_puzzle(cache_path, cache_key, network: dict):
+    """Store normalized puzzle data so the next load can skip parsing it.
+    Args:
+        cache_path: Path - the cache file
+        cache_key: tuple - the app and normalizer versions and the puzzle file's hash
+        network: dict - the normalized "Network" JSON data
+    """
+    temp_path = cache_path.with_suffix(".tmp")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path.write_bytes(marshal.dumps((cache_key, network)))
+        os.replace(temp_path, cache_path)
+    except (OSError, ValueError) as e:
+        # The cache only saves time; the puzzle still loads without it.
+        logging.warning(f"Could not write puzzle cache {cache_path}: {e}")
+
+
 def choosePuzzleFromName(what: str):
     """
     Choose a puzzle using the puzzle name.
@@ -1154,8 +1791,8 @@ def choosePuzzleFromName(what: str):
     # print ("Length of puzzleslist: " + str(len(puzzlelist)))
 
     for one in session.puzzlelist:
-        if one["EduNetworkBuilder"]["Network"]["name"] == what:
-            return copy.deepcopy(one["EduNetworkBuilder"]["Network"])
+        if one["name"] == what:
+            return read_puzzle_data(what)
 
 
 def choosePuzzle(what, filter=None):
@@ -1184,18 +1821,16 @@ def choosePuzzle(what, filter=None):
                 1  # This command does nothing.  It allows us to have an exception that does not blow anything up
 
     if isinstance(what, int):
-        puz = copy.deepcopy(session.puzzlelist[what]["EduNetworkBuilder"]["Network"])
+        puz = read_puzzle_data(session.puzzlelist[what]["name"])
     else:
         try:
             # if the int(what) fails, we treat it as a name
-            puz = copy.deepcopy(
-                session.puzzlelist[int(what)]["EduNetworkBuilder"]["Network"]
-            )
+            puz = read_puzzle_data(session.puzzlelist[int(what)]["name"])
         except Exception:
             puz = choosePuzzleFromName(what)
     if puz is not None:
         session.print("Loaded: " + puz["name"])
-        session.puzzle = Puzzle(puz)
+        session.puzzle = Puzzle(puz, normalized=True)
         session.puzzle.set_all_device_nic_macs()
         session.puzzle.AutoJoinAllWireless()
     return puz
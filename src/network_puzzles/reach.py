@@ -0,0 +1,453 @@
+"""Work out whether a ping gets through without simulating its packets.
+
+The walk follows the same decisions the packet simulator makes (routes, switch
+ports, firewalls, NAT on WAN ports, broken links, interference) but it only
+reads the puzzle; nothing is learned or recorded along the way. The simulator
+is still the reference: anything the walk cannot follow, like VPN tunnels, is
+reported as unknown rather than guessed at.
+"""
+
+import ipaddress
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+
+from . import device, packet, session
+from .interface import BROADCAST_MAC
+from .link import Link
+from .nic import Nic
+
+# How far a traced packet moves per step, in percent of a link. This matches the
+# default tick, so damage and weak signals are found at the same spots.
+TRACE_TICK_PCT = 10
+
+
+@dataclass
+class Reachability:
+    """The outcome of tracing a ping and its response.
+    reachable is True or False, or None if the trace could not tell.
+    """
+
+    source: str
+    destination: str
+    reachable: bool | None = None
+    path: list = field(default_factory=list)
+    reason: str = ""
+    health: int = 100
+    hops: int = 0  # links crossed by the ping, not counting its response
+
+    def __str__(self):
+        match self.reachable:
+            case True:
+                if self.health < 100:
+                    verdict = f"damaged (health {self.health})"
+                else:
+                    verdict = "reachable"
+            case False:
+                verdict = "unreachable"
+            case _:
+                verdict = "unknown"
+        s = f"{self.source} -> {self.destination}: {verdict}"
+        if self.path:
+            s += f"; path: {' > '.join(self.path)}"
+        if self.reason:
+            s += f"; {self.reason}"
+        return s
+
+
+class _Blocked(Exception):
+    """Raised to end a traced packet; the message says why."""
+
+
+class _Ignored(_Blocked):
+    """Raised for copies of a packet that were never meant to get through, like
+    flooded copies reaching the wrong host."""
+
+
+class _Unknown(Exception):
+    """Raised when the trace reaches something it does not model."""
+
+
+class Tracer:
+    """Traces pings through the loaded puzzle.
+    A tracer keeps scratch NAT tables for the devices it passes through, so it
+    should be used for a single ping and its response.
+    Args:
+        lookups: dict - answers that only depend on the puzzle (routes, ARP, link
+            ends, damage along links). Tracers given the same dict share them.
+    """
+
+    def __init__(self, lookups=None):
+        self._nat = {}
+        self._failures = []
+        self._seen = set()
+        self._lookups = {} if lookups is None else lookups
+
+    def _lookup(self, kind, key, build):
+        """Return a stored answer, working it out with build() the first time."""
+        answers = self._lookups.setdefault(kind, {})
+        if key not in answers:
+            answers[key] = build()
+        return answers[key]
+
+    def ping(self, src, dest) -> Reachability:
+        """Trace a ping and its response.
+        Args:
+            src: dict - the source device JSON
+            dest: dict | str - the destination device JSON, or an IP address
+        returns: Reachability
+        """
+        src_dev = device.Device.shared(src)
+        if isinstance(dest, dict):
+            dest_name = dest.get("hostname")
+        else:
+            dest_name = str(dest)
+        result = Reachability(src_dev.hostname, dest_name)
+        try:
+            pkt = self._new_packet(src_dev, dest, "ping")
+            pkt.justcreated = True
+            if pkt.destination_mac != BROADCAST_MAC:
+                self._round_trip(src_dev, pkt, None, result)
+            else:
+                # Everything on the segment that has the broadcast IP answers; the
+                # ping works if any one answer gets back.
+                failure = None
+                for target in self._broadcast_targets(src_dev, pkt):
+                    try:
+                        self._round_trip(src_dev, pkt.clone(), target, result)
+                        break
+                    except _Blocked as e:
+                        failure = failure or e
+                else:
+                    raise failure
+            result.reachable = True
+        except _Blocked as e:
+            result.reachable = False
+            result.reason = str(e)
+        except _Unknown as e:
+            result.reason = str(e)
+        except ValueError as e:
+            # Addresses the puzzle has wrong, like a bad netmask, cannot be followed.
+            result.reason = f"bad address data: {e}"
+        return result
+
+    def _round_trip(self, src_dev, pkt, target, result):
+        """Trace a ping to its destination and the response back, filling in result.
+        Args:
+            target: str - for broadcasts, the hostname whose answer is traced
+        """
+        responder = self._deliver(src_dev, pkt, target)
+
+        # The response goes back to whichever device owns the source IP it saw.
+        reply_ip = packet.justIP(str(pkt.source_ip))
+        reply_to = self._lookup(
+            "owner", reply_ip, lambda: device.deviceFromIP(reply_ip)
+        )
+        if reply_to is None:
+            raise _Blocked(f"{responder.hostname} has no device to reply to")
+        response = self._new_packet(responder, reply_to, "ping-response")
+        self._deliver(responder, response)
+        result.path = pkt.path + response.path
+        result.hops = len(pkt.path)
+        result.health = min(pkt.health, response.health)
+
+    def _broadcast_targets(self, src_dev, pkt):
+        """Return the hostnames that would answer a broadcast ping, in puzzle order.
+        Only devices in the sending card's broadcast domain can hear it.
+        raises: _Blocked if nothing in the domain has the broadcast IP
+        """
+        route_out = src_dev.route_out(pkt.destination_ip)
+        if route_out is None:
+            raise _Blocked(f"{src_dev.hostname} has no route to {pkt.destination_ip}")
+        route_nic = route_out[2]
+        domain = session.puzzle.broadcast_domain(route_nic.uniqueidentifier)
+        targets = []
+        for dev_data in session.puzzle.devices:
+            dev = device.Device.shared(dev_data)
+            if dev.hostname == src_dev.hostname:
+                continue
+            if any(
+                n.uniqueidentifier in domain for n in dev.nics
+            ) and device.deviceHasIP(dev.json, pkt.destination_ip):
+                targets.append(dev.hostname)
+        if not targets:
+            raise _Blocked(
+                f"nothing on {src_dev.hostname}'s network answers {pkt.destination_ip}"
+            )
+        return targets
+
+    def _new_packet(self, src_dev, dest, packettype):
+        """Build a packet the way Device.create_packet does, without touching the ARP tables."""
+        if isinstance(dest, dict):
+            key = (src_dev.hostname, dest.get("hostname"))
+        else:
+            key = (src_dev.hostname, str(dest))
+        addresses = self._lookup(
+            "addresses", key, lambda: self._packet_addresses(src_dev, dest)
+        )
+        if isinstance(addresses, Exception):
+            raise type(addresses)(str(addresses))
+        pkt = packet.Packet()
+        pkt.packettype = packettype
+        pkt.source_ip, pkt.destination_ip, pkt.destination_mac = addresses
+        return pkt
+
+    def _packet_addresses(self, src_dev, dest):
+        """Work out the source IP, destination IP and destination MAC of a new packet.
+        returns: a tuple of the three, or the exception that stops the packet
+        """
+        try:
+            return self._find_packet_addresses(src_dev, dest)
+        except (_Blocked, _Unknown) as e:
+            return e
+        except ValueError as e:
+            # e.g. a netmask in the puzzle that is not a valid one
+            return _Unknown(f"bad address on {src_dev.hostname}: {e}")
+
+    def _find_packet_addresses(self, src_dev, dest):
+        if isinstance(dest, dict):
+            dest_ip = device.destIP(src_dev.json, dest)
+            if dest_ip is None:
+                raise _Blocked(f"no IP address for {dest.get('hostname')}")
+            dest_ip = ipaddress.IPv4Address(packet.justIP(str(dest_ip)))
+        else:
+            dest_ip = ipaddress.IPv4Address(dest)
+        if packet.isEmpty(dest_ip):
+            raise _Blocked(f"not a valid target: {dest_ip}")
+
+        source_ip = device.sourceIP(src_dev.json, dest_ip, False)
+        if source_ip is None:
+            raise _Blocked(f"no route from {src_dev.hostname} to {dest_ip}")
+        if device.ip_is_broadcast_for_device(src_dev.json, dest_ip):
+            dest_mac = BROADCAST_MAC
+        else:
+            dest_mac = device.globalArpLookup(dest_ip)
+        if dest_mac is None:
+            raise _Blocked(f"no device has the IP {dest_ip}")
+        return source_ip, dest_ip, dest_mac
+
+    def _deliver(self, src_dev, pkt, target=None):
+        """Follow a packet from the device sending it to the device it is for.
+        Flooded copies are followed breadth first, so the first copy to arrive wins.
+        Args:
+            target: str - for broadcasts, the hostname of the one destination to follow
+        returns: device.Device - the destination
+        raises: _Blocked if no copy arrives, with the reason the first copy stopped
+        """
+        self._failures = []
+        self._seen = set()
+        pending = deque()
+        self._send(src_dev, pkt, None, pending)
+        while pending:
+            dev, nic, pkt_copy = pending.popleft()
+            try:
+                if self._arrive(dev, nic, pkt_copy, pending) and (
+                    target is None or dev.hostname == target
+                ):
+                    pkt.json.update(pkt_copy.json)
+                    return dev
+            except _Blocked as e:
+                self._failures.append(e)
+        failures = [e for e in self._failures if not isinstance(e, _Ignored)]
+        if failures or self._failures:
+            raise _Blocked(str((failures or self._failures)[0]))
+        raise _Blocked("the packet did not reach anything")
+
+    def _send(self, dev, pkt, inbound_nic, pending):
+        """Route a packet out of a device, as Device.send_packet does."""
+        route_out = self._lookup(
+            "route",
+            (dev.hostname, str(pkt.destination_ip)),
+            lambda: dev.route_out(pkt.destination_ip),
+        )
+        if route_out is None:
+            raise _Blocked(f"{dev.hostname} has no route to {pkt.destination_ip}")
+        route, route_interface, route_nic = route_out
+        dev.address_for_route(pkt, route, route_nic)
+
+        if route_nic.name == "management_interface0":
+            self._flood(dev, pkt, inbound_nic, pending)
+            return
+        if route_nic.type == "vpn":
+            raise _Unknown(f"VPN tunnels are not traced ({dev.hostname})")
+        link_data = route_nic.get_connected_link()
+        if link_data is None:
+            raise _Blocked(f"{dev.hostname} {route_nic.name} is not connected")
+
+        dev.track_outbound(pkt, route_interface, route_nic, self._nat_table(dev))
+        if pkt.packettype not in ("ping-response", "traceroute-response"):
+            # Checked without AdvFirewallAllows so the rule hit counts stay untouched.
+            if dev.firewall.verdict(pkt.in_interface, route_interface.nicname) is False:
+                raise _Blocked(f"dropped by the firewall on {dev.hostname}")
+        self._cross(dev, link_data, pkt, pending)
+
+    def _flood(self, dev, pkt, inbound_nic, pending):
+        """Copy a packet out of a hub or switch, as Device._send_out_hubswitch does."""
+        for _, link_data in dev.flood_ports(pkt, inbound_nic):
+            try:
+                self._cross(dev, link_data, pkt.clone(), pending)
+            except _Blocked as e:
+                self._failures.append(e)
+
+    def _cross(self, dev, link_data, pkt, pending):
+        """Send a packet along a link and queue its arrival at the far end."""
+        lnk = Link.shared(link_data)
+        if lnk.linktype == "broken":
+            raise _Blocked(f"{lnk.hostname} is broken")
+        pkt.enter_link(link_data, dev.hostname)
+        key = (lnk.uniqueidentifier, pkt.direction, lnk.linktype)
+        for hit in self._lookup("damage", key, lambda: self._link_hits(pkt, lnk)):
+            if hit is None:
+                raise _Blocked(f"wireless signal too weak across {lnk.hostname}")
+            pkt.health -= 1
+            if hit.mytype == "tree":
+                raise _Blocked(f"{hit.hostname} blocks {lnk.hostname}")
+            if pkt.health <= 0:
+                raise _Blocked(f"interference on {lnk.hostname}")
+
+        far_end = self._lookup("far end", key, lambda: self._far_end(pkt))
+        if far_end is None:
+            raise _Blocked(f"{lnk.hostname} does not lead anywhere")
+        dev_data, nic_data = far_end
+        pending.append((device.Device.shared(dev_data), Nic.shared(nic_data), pkt))
+
+    def _link_hits(self, pkt, lnk):
+        """Walk a packet along a link one tick at a time and list what happens to it.
+        returns: a list with the device for each point of damage, in order, and None
+            where the wireless signal gets too weak. The list stops at anything that
+            would stop every packet: a tree or a weak signal.
+        """
+        hits = []
+        profile = session.puzzle.damage_profile(pkt, lnk)
+        if profile is None:
+            return hits
+        risky_devices, weak_signal_pcts = profile
+        while pkt.distance <= 100:
+            all_pcts = pkt.get_distance_pcts(TRACE_TICK_PCT)
+            for dev, damaging_pcts in risky_devices:
+                for dist_pct in all_pcts:
+                    if dist_pct in damaging_pcts:
+                        hits.append(dev)
+                        if dev.mytype == "tree":
+                            return hits
+            if lnk.linktype == "wireless" and all_pcts[-1] in weak_signal_pcts:
+                hits.append(None)
+                return hits
+            pkt.distance += TRACE_TICK_PCT
+        return hits
+
+    def _far_end(self, pkt):
+        """Return the (device json, nic json) a packet arrives at, or None."""
+        dest_nic = pkt.get_current_link_endpoint_nics()[1]
+        dev_data = session.puzzle.device_from_uid(dest_nic.my_id.host_id)
+        if dev_data is None:
+            return None
+        return dev_data, dest_nic.json
+
+    def _arrive(self, dev, nic, pkt, pending):
+        """Take a packet into a device, as Nic.receive_packet and Nic.begin_ingress do.
+        returns: True if this device is the packet's destination
+        """
+        if not dev.powered_on:
+            raise _Blocked(f"{dev.hostname} is powered off")
+        if dev.frozen:
+            raise _Blocked(f"{dev.hostname} is frozen")
+        # The simulator lets looping packets run until they time out; a packet that
+        # comes back the same way a second time will never get anywhere new.
+        state = (dev.hostname, nic.name, str(pkt.destination_ip), pkt.destination_mac)
+        if state in self._seen:
+            raise _Ignored(f"the packet loops back to {dev.hostname}")
+        self._seen.add(state)
+        pkt.path.append(dev.hostname)
+
+        tdest_ip = pkt.json.get("tdestIP")
+        pkt.in_interface = self._lookup(
+            "interface",
+            (nic.uniqueidentifier, str(tdest_ip)),
+            lambda: nic.ingress_interface(tdest_ip),
+        )
+        pkt.justcreated = False
+
+        if nic.type == "wan" and not dev.admit_from_wan(pkt, self._nat_table(dev)):
+            raise _Blocked(f"blocked coming into {dev.hostname} {nic.name}")
+        if pkt.destination_mac is None:
+            raise _Blocked(f"no MAC address for {pkt.destination_ip}")
+        if not nic.accepts(pkt, dev):
+            raise _Ignored(f"{dev.hostname} ignores a packet for another MAC")
+        return self._receive(dev, nic, pkt, pending)
+
+    def _receive(self, dev, nic, pkt, pending):
+        """Decide what a device does with a packet, as Device.receive_packet does."""
+        dest_ip = pkt.destination_ip
+        if self._lookup(
+            "has ip",
+            (dev.hostname, str(dest_ip)),
+            lambda: (
+                not packet.isEmpty(dest_ip) and device.deviceHasIP(dev.json, dest_ip)
+            ),
+        ):
+            logging.debug(f"Traced {pkt} to {dev.hostname}")
+            return True
+        if dev.forwards_packets and dev.mytype != "wrouter":
+            self._flood(dev, pkt, nic, pending)
+            return False
+        if not dev.routes_packets:
+            raise _Blocked(f"{dev.hostname} does not forward packets")
+        if dev.mytype == "router" and packet.isLocal(pkt.source_ip, pkt.destination_ip):
+            raise _Blocked(f"{dev.hostname} will not route back onto the same network")
+        self._send(dev, pkt, nic, pending)
+        return False
+
+    def _nat_table(self, dev):
+        """Return a scratch NAT table for the device.
+        The CLI clears every NAT table before it runs a ping's packets, so the
+        scratch tables start out empty too.
+        """
+        if dev.hostname not in self._nat:
+            self._nat[dev.hostname] = device.ConnectionTable([])
+        return self._nat[dev.hostname]
+
+
+def trace_ping(src, dest) -> Reachability:
+    """Work out whether a ping from src to dest would succeed.
+    Args:
+        src: dict - the source device JSON
+        dest: dict | str - the destination device JSON, or an IP address
+    returns: Reachability
+    """
+    return Tracer().ping(src, dest)
+
+
+def ip_devices():
+    """Return the devices in the loaded puzzle that have an IP address to ping."""
+    found = []
+    for dev_data in session.puzzle.devices:
+        for onenic in device.Device.shared(dev_data).nics:
+            if any(
+                address.get("ip") and not packet.isEmpty(address.get("ip"))
+                for address in onenic.ip_addresses
+            ):
+                found.append(dev_data)
+                break
+    return found
+
+
+def reach_matrix(devices=None) -> dict:
+    """Work out which devices can ping which, for every pair of devices.
+    The traces share their route, ARP and link lookups, so a whole matrix costs
+    little more than the pings that differ.
+    Args:
+        devices: list - device JSON to check, defaulting to ip_devices()
+    returns: a dict of {(source hostname, destination hostname): Reachability}
+    """
+    if devices is None:
+        devices = ip_devices()
+    lookups = {}
+    matrix = {}
+    for src in devices:
+        for dest in devices:
+            if src is dest:
+                continue
+            result = Tracer(lookups).ping(src, dest)
+            matrix[(src.get("hostname"), dest.get("hostname"))] = result
+    return matrix
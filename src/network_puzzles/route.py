@@ -1,3 +1,5 @@
+import ipaddress
+
 from .core import ItemBase
 
 
@@ -82,3 +84,83 @@ class Route(ItemBase):
     @type.setter
     def type(self, value):
         self.json["type"] = value
+
+
+class ForwardingTable:
+    """A device's routes, parsed once so that packets can be routed without re-parsing them.
+
+    Routes are chosen the same way Device.get_route_for_dest_ip always has: a
+    matching static route first, then a local interface, then the default gateway.
+    """
+
+    def __init__(self, static_routes, interfaces, default_gateway):
+        """
+        Args:
+            static_routes: list - the device's static route records, in order
+            interfaces: list - the interface records of every nic that can have an IP, in order
+            default_gateway: str - the device's default gateway IP
+        """
+        self.static_routes = []
+        for route_data in static_routes:
+            route = Route(route_data)
+            network = ipaddress.ip_network(route.network, strict=False)
+            self.static_routes.append((network, route.gateway))
+        self.interfaces = []
+        for iface in interfaces:
+            ip = iface.get("myip", {})
+            try:
+                address = ipaddress.ip_interface(f"{ip.get('ip')}/{ip.get('mask')}")
+            except ValueError:
+                # Interfaces without a valid IP are never local to anything.
+                continue
+            is_zero = str(address) == "0.0.0.0/0"
+            self.interfaces.append((address.network, is_zero, iface))
+        self.default_gateway = default_gateway
+        self._lookups = {}
+
+    def lookup(self, dest_ip):
+        """Find the way to the destination IP
+        Args: dest_ip: str - the destination IP
+        returns: a tuple of (gateway, interface record); either may be None
+        """
+        # Broadcasts may go out an interface that does not have an IP yet.
+        skip_zeros = dest_ip != "255.255.255.255"
+        key = (str(dest_ip), skip_zeros)
+        if key not in self._lookups:
+            self._lookups[key] = self._resolve(dest_ip, skip_zeros)
+        return self._lookups[key]
+
+    def local_interface(self, target_ip, skip_zeros=True):
+        """Return the first interface record on the same network as the target IP, or None."""
+        target = _parse_ip(target_ip)
+        if target is None:
+            return None
+        for network, is_zero, iface in self.interfaces:
+            if skip_zeros and is_zero:
+                continue
+            if target in network:
+                return iface
+        return None
+
+    def _resolve(self, dest_ip, skip_zeros):
+        gateway = None
+        interface = None
+        destination = ipaddress.ip_address(str(dest_ip).split("/")[0])
+        for network, route_gateway in self.static_routes:
+            if destination in network:
+                gateway = route_gateway
+                break
+        if not gateway:
+            interface = self.local_interface(dest_ip, skip_zeros)
+        if not interface and not gateway:
+            gateway = self.default_gateway
+        if gateway and not interface:
+            interface = self.local_interface(gateway)
+        return (gateway, interface)
+
+
+def _parse_ip(ip):
+    try:
+        return ipaddress.ip_address(str(ip).split("/")[0])
+    except ValueError:
+        return None
@@ -18,15 +18,11 @@ class UI:
         return session.puzzle
 
     def acknowledge_any_tests(self):
-        for test_data in self.puzzle.tests:
+        for test_data in self.puzzle.take_unacknowledged_tests():
             test = puzzle.PuzzleTest(test_data)
-            if (
-                test.name == "SuccessfullyPingsWithoutLoop"
-                and session.packetstorm
-                and not test.acknowledged
-            ):
-                test.completed = False
-            if test.completed and not test.acknowledged:
+            if test.name == "SuccessfullyPingsWithoutLoop" and session.packetstorm:
+                self.puzzle.reopen_test(test_data)
+            if test.completed:
                 # we have something completed, but not acknowledged
                 if test.message:
                     session.print(test.message)
@@ -160,9 +156,8 @@ class CLI(UI):
             if count > 5:
                 self.acknowledge_any_tests()
                 count = 0
-            # The cli does not need much time to know packets are going to
-            # loop forever.
-            session.puzzle.process_packets(2)
+            # Nothing is animated in the CLI, so skip straight to each event.
+            session.puzzle.process_next_packet_event()
         session.puzzle.AfterPacketsNoticeFailedPings()
 
     def prompt(self):
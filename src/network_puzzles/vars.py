@@ -61,6 +61,11 @@ match OS:
 if not USER_DATA_DIR.is_dir():
     USER_DATA_DIR.mkdir()
 
+# Set PUZZLE CACHE DIR; the tests point this at a temporary directory.
+PUZZLE_CACHE_DIR = USER_DATA_DIR / "puzzle-cache"
+if "NETWORKPUZZLES_CACHE_DIR" in os.environ:
+    PUZZLE_CACHE_DIR = Path(os.getenv("NETWORKPUZZLES_CACHE_DIR"))
+
 
 class Session:
     # NOTE: Session is instantiated when the app opens, even before the UI is
@@ -1,9 +1,19 @@
+import atexit
+import os
+import shutil
 import sys
+import tempfile
 from pathlib import Path
 
 # Add package dir to PYTHONPATH.
 sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
 
+# Keep the puzzle cache out of the user's data dir.
+if "NETWORKPUZZLES_CACHE_DIR" not in os.environ:
+    cache_dir = tempfile.mkdtemp(prefix="networkpuzzles-cache-")
+    os.environ["NETWORKPUZZLES_CACHE_DIR"] = cache_dir
+    atexit.register(shutil.rmtree, cache_dir, ignore_errors=True)
+
 # Empty out unittest args to avoid interference with argparse.
 if sys.argv[0].endswith("unittest"):
     sys.argv = sys.argv[:1]
@@ -27,3 +27,15 @@ class TestValidateJSON(unittest.TestCase):
         valid_data = {"key": ["value"]}
         core.conform_json_values(data, "key")
         self.assertEqual(data, valid_data)
+
+
+class TestJSONValues(unittest.TestCase):
+    def test_json_bool(self):
+        self.assertTrue(core.json_bool("True"))
+        self.assertTrue(core.json_bool("yes"))
+        self.assertFalse(core.json_bool("false"))
+        self.assertFalse(core.json_bool(None))
+        self.assertTrue(core.json_bool(None, default=True))
+
+    def test_json_location(self):
+        self.assertEqual(core.json_location("120,45"), (120, 45))
@@ -1,7 +1,7 @@
 import json
 import unittest
 
-from network_puzzles import device, session, ui
+from network_puzzles import device, packet, session, ui
 
 from . import PUZZLES_DIR
 
@@ -29,6 +29,26 @@ class TestDeviceProperties(unittest.TestCase):
         dev.json["poweroff"] = "True"
         self.assertFalse(dev.powered_on)
 
+    def test_dhcp_leases(self):
+        self.app.load_puzzle("Level0_SimpleDHCP")
+        server = device.Device("server0")
+        self.assertEqual("192.168.1.50", server._free_dhcp_ip("192.168.1.2"))
+        server.dhcp_list["AAAAAAAAAAAA"] = "192.168.1.50"
+        server.dhcp_list["BBBBBBBBBBBB"] = "192.168.1.51"
+        self.assertEqual("192.168.1.52", server._free_dhcp_ip("192.168.1.2"))
+        self.assertEqual("", server._free_dhcp_ip("10.0.0.1"))
+
+    def test_dhcp_lease_reused(self):
+        self.app.load_puzzle("Level0_SimpleDHCP")
+        server = device.Device("server0")
+        self.app.parser.parse("dhcp")
+        self.app.process_packets()
+        leases = dict(server.dhcp_list)
+        self.assertEqual(["192.168.1.50"], list(leases.values()))
+        self.app.parser.parse("dhcp")
+        self.app.process_packets()
+        self.assertEqual(leases, server.dhcp_list)
+
 
 class TestGetDeviceAttribs(unittest.TestCase):
     def setUp(self):
@@ -137,3 +157,169 @@ class TestXFromY(unittest.TestCase):
 
     def test_nicfromname_withuid_notfound(self):
         self.assertIsNone(device.Device("not_exist").nic_from_name("lo0"))
+
+
+class TestRoutes(unittest.TestCase):
+    def setUp(self):
+        self.app = ui.CLI()
+        self.app.load_puzzle("Level0_HubVsSwitch")
+
+    def test_route_default_gateway(self):
+        route = device.Device("pc0").get_route_for_dest_ip("10.1.1.1")
+        self.assertEqual("192.168.1.1", route.gateway)
+        self.assertEqual("192.168.1.5", route.interface.get("myip").get("ip"))
+
+    def test_route_local(self):
+        route = device.Device("router0").get_route_for_dest_ip("192.168.3.7")
+        self.assertIsNone(route.gateway)
+        self.assertEqual("192.168.3.1", route.interface.get("myip").get("ip"))
+
+    def test_route_static(self):
+        route = device.Device("router0").get_route_for_dest_ip("192.168.2.7")
+        self.assertEqual("192.168.3.2", route.gateway)
+        self.assertEqual("192.168.3.1", route.interface.get("myip").get("ip"))
+
+    def test_route_out(self):
+        route, route_interface, route_nic = device.Device("pc0").route_out("10.1.1.1")
+        self.assertEqual("192.168.1.1", route.gateway)
+        self.assertEqual("192.168.1.5", route_interface.ip)
+        self.assertEqual("eth0", route_nic.name)
+        self.assertIsNone(device.Device("pc0").route_out("0.0.0.0"))
+
+    def test_flood_ports(self):
+        switch = device.Device("net_switch0")
+        pkt = packet.Packet()
+        pkt.destination_mac = "DB19B9B9EE9E"
+        ports = [n.name for n, _ in switch.flood_ports(pkt)]
+        self.assertEqual(["port1", "port2", "port3"], ports)
+        # Once the switch has learned the port, it only uses that one.
+        switch.port_arps["DB19B9B9EE9E"] = "port2"
+        self.assertEqual(["port2"], [n.name for n, _ in switch.flood_ports(pkt)])
+        inbound = switch.nics[3]
+        self.assertEqual([], switch.flood_ports(pkt, inbound))
+
+    def test_route_changes(self):
+        router0 = device.Device("router0")
+        self.assertEqual(
+            "192.168.3.2", router0.get_route_for_dest_ip("10.0.0.7").gateway
+        )
+        router0.route_add("10.0.0.0/8", "192.168.1.9")
+        self.assertEqual(
+            "192.168.1.9", router0.get_route_for_dest_ip("10.0.0.7").gateway
+        )
+        router0.route_del("10.0.0.0/8", "192.168.1.9")
+        self.assertEqual(
+            "192.168.3.2", router0.get_route_for_dest_ip("10.0.0.7").gateway
+        )
+        self.app.parser.parse("set router0 eth1 10.0.0.1/8")
+        route = router0.get_route_for_dest_ip("10.0.0.7")
+        self.assertIsNone(route.gateway)
+        self.assertEqual("10.0.0.1", route.interface.get("myip").get("ip"))
+
+
+class TestConnectionTable(unittest.TestCase):
+    def test_reply_consumes_connection(self):
+        records = []
+        table = device.ConnectionTable(records)
+        table.add("8.8.8.8", "192.168.1.5/24", "ping", "masq", masq_ip="10.0.0.2")
+        self.assertEqual("10.0.0.2", records[0]["src"])
+        self.assertEqual("192.168.1.5", records[0]["masqsrc"])
+        # The outbound packet itself is not a reply.
+        self.assertIsNone(table.consume("8.8.8.8", "10.0.0.2", "ping"))
+        connection = table.consume("10.0.0.2", "8.8.8.8", "ping-response")
+        self.assertEqual("masq", connection["response"])
+        self.assertEqual([], records)
+        self.assertIsNone(table.consume("10.0.0.2", "8.8.8.8", "ping-response"))
+        self.assertEqual((1, 2), (table.matched, table.unmatched))
+
+    def test_old_connections_dropped(self):
+        records = []
+        table = device.ConnectionTable(records, lifetime=100)
+        table.add("8.8.8.8", "10.0.0.2", "ping", "accept", now=0)
+        table.add("8.8.4.4", "10.0.0.2", "ping", "accept", now=50)
+        self.assertIsNone(table.consume("10.0.0.2", "8.8.8.8", "ping-response", 120))
+        self.assertIsNotNone(table.consume("10.0.0.2", "8.8.4.4", "ping-response", 120))
+        for count in range(device.MAX_IP_CONNECTIONS + 5):
+            table.add("8.8.8.8", f"10.0.{count // 250}.{count % 250}", "ping", "accept")
+        self.assertEqual(device.MAX_IP_CONNECTIONS, len(records))
+        self.assertEqual("10.0.0.5", records[0]["src"])
+        self.assertEqual(6, table.evicted)
+
+    def test_identical_connections(self):
+        records = []
+        table = device.ConnectionTable(records, lifetime=100)
+        first = table.add("8.8.8.8", "10.0.0.2", "ping", "accept", now=0)
+        second = table.add("8.8.8.8", "10.0.0.2", "ping", "accept", now=50)
+        self.assertEqual(first, second)
+        connection = table.consume("10.0.0.2", "8.8.8.8", "ping-response", 60)
+        self.assertIs(first, connection)
+        self.assertEqual(1, len(records))
+        self.assertIs(second, records[0])
+        # The record left keeps its own age.
+        self.assertIsNotNone(table.consume("10.0.0.2", "8.8.8.8", "ping-response", 120))
+
+    def test_table_follows_device(self):
+        app = ui.CLI()
+        app.load_puzzle("Level1_Practice1")
+        dev = device.Device("firewall0")
+        dev.AddIPConnectionEntry("8.8.8.8", "10.0.0.2", "ping", "accept")
+        self.assertEqual(1, len(dev.ip_connections))
+        app.puzzle.ClearAllConnectionEntries()
+        self.assertEqual([], dev.ip_connections)
+        self.assertEqual([], dev.connection_table.records)
+
+
+class TestFirewall(unittest.TestCase):
+    def setUp(self):
+        self.app = ui.CLI()
+        self.app.load_puzzle("Level2_FirewallTest2")
+        self.firewall0 = device.Device("firewall0")
+
+    def test_rule_hits(self):
+        self.assertFalse(self.firewall0.AdvFirewallAllows("eth0", "eth1"))
+        self.assertTrue(self.firewall0.AdvFirewallAllows("eth1", "eth0"))
+        self.app.parser.parse("ping pc1 pc3")
+        self.app.process_packets()
+        firewall = self.firewall0.firewall
+        hits = [firewall.rule_hits(r) for r in self.firewall0.firewall_rules]
+        self.assertEqual(2, sum(hits))
+        self.assertEqual(2, hits[0])
+
+    def test_rule_hits_per_rule(self):
+        rules = [
+            {"source": "eth0", "destination": "eth1", "action": "Drop"},
+            {"source": "eth0", "destination": "eth1", "action": "Allow"},
+            {"source": "eth1", "destination": "eth0", "action": "Drop"},
+        ]
+        firewall = device.FirewallRules(rules)
+        firewall.record_hit("eth0", "eth1")
+        firewall.record_hit("eth1", "eth0")
+        firewall.record_hit("eth1", "eth0")
+        firewall.record_hit("eth2", "eth0")
+        self.assertEqual([1, 0, 2], [firewall.rule_hits(r) for r in rules])
+
+    def test_rules_edited_in_place(self):
+        # The firewall popup removes a rule from the list before the command runs.
+        rules = self.firewall0.firewall_rules
+        self.assertFalse(self.firewall0.AdvFirewallAllows("eth0", "eth1"))
+        # The compiled rules are kept between packets.
+        self.assertIs(self.firewall0.firewall, self.firewall0.firewall)
+        rules.remove(rules[0])
+        self.firewall0.firewall_changed()
+        self.assertTrue(self.firewall0.AdvFirewallAllows("eth0", "eth1"))
+        rules.append({"source": "eth0", "destination": "eth1", "action": "drop"})
+        self.firewall0.firewall_changed()
+        self.assertFalse(self.firewall0.AdvFirewallAllows("eth0", "eth1"))
+        self.firewall0.AdvFirewallAdd("eth0", "eth1", "allow")
+        self.assertTrue(self.firewall0.AdvFirewallAllows("eth0", "eth1"))
+
+    def test_rule_changes(self):
+        self.app.parser.parse("firewall firewall0 add eth0 eth1 allow")
+        self.assertTrue(self.firewall0.AdvFirewallAllows("eth0", "eth1"))
+        self.firewall0.AdvFirewallAdd("eth1", "eth0", "DROP")
+        self.assertFalse(self.firewall0.AdvFirewallAllows("eth1", "eth0"))
+        self.firewall0.AdvFirewallDel("eth1", "eth0", "drop")
+        self.assertTrue(self.firewall0.AdvFirewallAllows("eth1", "eth0"))
+        self.app.parser.parse("undo")
+        firewall0 = device.Device("firewall0")
+        self.assertFalse(firewall0.AdvFirewallAllows("eth0", "eth1"))
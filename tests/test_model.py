@@ -0,0 +1,17 @@
+import unittest
+
+from network_puzzles import model, packet
+
+
+class TestTypes(unittest.TestCase):
+    def test_compare_as_json_values(self):
+        self.assertEqual("wport", model.NicType.WPORT)
+        self.assertEqual('"wport"', f'"{model.NicType.WPORT}"')
+        self.assertIs(model.NicType("lo"), model.NicType.LO)
+
+    def test_packet_types(self):
+        pkt = packet.Packet()
+        pkt.packettype = "Ping-Response"
+        self.assertEqual(model.PacketType.PING_RESPONSE, pkt.packettype)
+        with self.assertRaises(ValueError):
+            pkt.packettype = "carrier-pigeon"
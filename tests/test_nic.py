@@ -1,7 +1,7 @@
 import json
 import unittest
 
-from network_puzzles import nic, ui
+from network_puzzles import nic, puzzle, ui
 
 from . import PUZZLES_DIR
 
@@ -29,11 +29,37 @@ class TestNicProperties(unittest.TestCase):
             nic.Nic(self.app.puzzle.nic_from_uid(nic_uid)).interfaces_data,
         )
 
+    def test_shared_wrappers(self):
+        nic_data = self.app.puzzle.nic_from_uid("104")
+        lo0 = nic.Nic.shared(nic_data)
+        self.assertIs(lo0, nic.Nic.shared(nic_data))
+        self.assertIs(lo0.interfaces[0], lo0.interfaces[0])
+        iface = lo0.interfaces[0]
+        iface.ip_data["ip"] = "127.0.0.2"
+        self.assertEqual("127.0.0.2", str(iface.ipaddress.ip))
+        self.app.puzzle.invalidate()
+        self.assertIsNot(lo0, nic.Nic.shared(nic_data))
+
+    def test_is_connected_by_name(self):
+        # Some puzzles have link ends whose card id belongs to another device, so
+        # is_connected goes by the device and card names at the link's end.
+        link_data = self.app.puzzle.link_from_name("pc0_link_net_switch0")
+        pc0_end = link_data["SrcNic"]
+        if pc0_end["hostname"] != "pc0":
+            pc0_end = link_data["DstNic"]
+        eth0 = nic.Nic(self.app.puzzle.nic_from_uid(pc0_end["nicid"]))
+        pc0_end["nicid"] = "no-such-nic"
+        self.app.puzzle.invalidate("link")
+        self.assertIsNone(eth0.get_connected_link())
+        self.assertTrue(eth0.is_connected())
+
     def test_nic_json(self):
         dev_idx = 0
         nic_idx = 0
         nic_uid = "104"
-        nic_json = self.data.get("device")[dev_idx].get("nic")[nic_idx]
+        # Loading puts the puzzle data into its canonical shape.
+        network = puzzle.normalize_puzzle(self.data)
+        nic_json = network.get("device")[dev_idx].get("nic")[nic_idx]
         app_json = nic.Nic(self.app.puzzle.nic_from_uid(nic_uid)).json
         # Remove extra runtime data.
         del app_json["Mac"]
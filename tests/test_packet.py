@@ -1,6 +1,7 @@
+import ipaddress
 import unittest
 
-from network_puzzles import device, nic, ui
+from network_puzzles import device, nic, packet, ui
 
 
 class TestPackets(unittest.TestCase):
@@ -42,3 +43,116 @@ class TestPackets(unittest.TestCase):
                         response_started = True
         self.assertTrue(ping_started)
         self.assertTrue(response_started)
+
+    def test_ping_timeout(self):
+        self.app.parser.parse("ping pc0 net_switch0")
+        pkt = self.app.puzzle.packets[0]
+        self.assertEqual(pkt.starttime, self.app.puzzle.sim_time)
+        # A packet that has used up its lifetime is killed, however fast the
+        # ticks are run.
+        self.app.puzzle.process_packets(tick_pct=10, lifetime=5)
+        self.assertFalse(self.app.puzzle.packets_need_processing())
+
+    def test_ping_timeout_seconds(self):
+        self.app.parser.parse("ping pc0 net_switch0")
+        # A twentieth of a second is less than one tick of packet movement.
+        self.app.puzzle.process_packets(0.05)
+        self.assertFalse(self.app.puzzle.packets_need_processing())
+
+    def test_ping_events(self):
+        self.app.parser.parse("ping pc0 net_switch0")
+        passes = 0
+        while self.app.puzzle.packets_need_processing():
+            self.app.puzzle.process_next_packet_event()
+            passes += 1
+        # The ping and its response each cross one link.
+        self.assertEqual(passes, 2)
+        # Each link takes 11 ticks of 10% to cross.
+        self.assertEqual(self.app.puzzle.sim_time, 220)
+
+    def test_move_packets(self):
+        self.app.parser.parse("ping pc0 net_switch0")
+        pkt = self.app.puzzle.packets[0]
+        self.app.puzzle._move_packets(tick_pct=10, ticks=5)
+        self.assertEqual(pkt.distance, 50)
+        self.assertEqual(self.app.puzzle.sim_time, 50)
+        self.assertEqual([pkt], self.app.puzzle.packets)
+
+    def test_clone(self):
+        self.app.parser.parse("ping pc0 net_switch0")
+        pkt = self.app.puzzle.packets[0]
+        pkt.path.append("pc0")
+        pkt.payload = {"data": "shared"}
+        copy = pkt.clone()
+        copy.packet_location = "elsewhere"
+        copy.path.append("net_switch0")
+        self.assertEqual(pkt.packet_location, "pc0_link_net_switch0")
+        self.assertEqual(["pc0"], pkt.path)
+        self.assertEqual(["pc0", "net_switch0"], copy.path)
+        self.assertIs(pkt.payload, copy.payload)
+
+    def test_clone_tunneled(self):
+        self.app.parser.parse("ping pc0 net_switch0")
+        inner = self.app.puzzle.packets[0]
+        outer = packet.Packet()
+        outer.payload = inner
+        copy = outer.clone()
+        self.assertIsNot(inner, copy.payload)
+        self.assertEqual(inner.json, copy.payload.json)
+
+
+class TestPacketDamage(unittest.TestCase):
+    def setUp(self):
+        self.app = ui.CLI()
+        self.app.load_puzzle("Level0_PacketCorruption1")
+        self.pkt = packet.Packet()
+        self.pkt.packet_location = "router0_link_laptop1"
+        self.pkt.direction = 1
+
+    def test_damage_profile(self):
+        risky_devices, weak_signal_pcts = self.app.puzzle.damage_profile(self.pkt)
+        self.assertEqual(["fluorescent0"], [d.hostname for d, _ in risky_devices])
+        self.assertEqual(set(), weak_signal_pcts)
+
+    def test_damage_profile_moved(self):
+        self.app.puzzle.damage_profile(self.pkt)
+        self.app.parser.parse("set fluorescent0 pos 20 20")
+        risky_devices, _ = self.app.puzzle.damage_profile(self.pkt)
+        self.assertEqual([], risky_devices)
+
+    def test_apply_damage(self):
+        self.pkt.apply_possible_damage(100)
+        self.assertLess(self.pkt.health, 100)
+
+
+class TestAddresses(unittest.TestCase):
+    def test_justip(self):
+        self.assertEqual("192.168.1.2", packet.justIP("192.168.1.2/24"))
+        self.assertEqual(
+            "192.168.1.2", packet.justIP(ipaddress.IPv4Address("192.168.1.2"))
+        )
+
+    def test_islocal(self):
+        self.assertTrue(packet.isLocal("192.168.1.7", "192.168.1.2/24"))
+        self.assertTrue(packet.isLocal("192.168.1.7", "192.168.1.2/255.255.255.0"))
+        self.assertTrue(
+            packet.isLocal(
+                ipaddress.IPv4Address("192.168.1.7"),
+                ipaddress.IPv4Interface("192.168.1.2/24"),
+            )
+        )
+        self.assertFalse(packet.isLocal("192.168.2.7", "192.168.1.2/24"))
+        self.assertFalse(packet.isLocal("192.168.1.7", "None"))
+        self.assertFalse(packet.isLocal("fe80::1", "192.168.1.2/24"))
+
+    def test_isbroadcast(self):
+        self.assertTrue(packet.isBroadcast("192.168.1.255", "192.168.1.2/24"))
+        self.assertFalse(packet.isBroadcast("192.168.1.254", "192.168.1.2/24"))
+        self.assertFalse(packet.isBroadcast("192.168.1.255", "not an ip"))
+
+    def test_isempty(self):
+        self.assertTrue(packet.isEmpty("0.0.0.0/24"))
+        self.assertTrue(packet.isEmpty(ipaddress.IPv4Address("0.0.0.0")))
+        self.assertTrue(packet.isEmpty(ipaddress.IPv4Interface("0.0.0.0/0")))
+        self.assertFalse(packet.isEmpty(ipaddress.IPv4Interface("0.0.0.0/24")))
+        self.assertFalse(packet.isEmpty("10.0.0.1"))
@@ -65,3 +65,23 @@ class TestSetValue(unittest.TestCase):
         self.assertTrue(dev.powered_on)
         self.app.parser.parse(f"set {dev_name} power off")
         self.assertFalse(dev.powered_on)
+
+
+class TestCachedLookups(unittest.TestCase):
+    def setUp(self):
+        self.app = ui.CLI()
+        self.app.load_puzzle("Level0_Ping")
+
+    def test_kept_across_unrelated_commands(self):
+        self.app.puzzle.arp_lookup("192.168.1.1")
+        arp_index = self.app.puzzle._arp_index()
+        self.app.parser.parse("set pc0 power off")
+        self.assertIs(arp_index, self.app.puzzle._arp_index())
+
+    def test_dropped_by_in_place_edits(self):
+        pc0 = device.Device(self.app.puzzle.device_from_name("pc0"))
+        eth0 = pc0.nics[1]
+        iface = eth0.interfaces[0]
+        self.app.puzzle.arp_lookup(iface.ipaddress)
+        iface.ip_obj.address = "10.9.9.9"
+        self.assertEqual(eth0.mac, self.app.puzzle.arp_lookup("10.9.9.9"))
@@ -1,5 +1,8 @@
+import hashlib
 import json
+import tempfile
 import unittest
+from pathlib import Path
 
 from network_puzzles import device, nic, puzzle, session, ui
 
@@ -74,17 +77,18 @@ class TestListItemsTypes(unittest.TestCase):
 
     def setUp(self):
         ui.CLI()  # populate session variables
+        puzzle.readPuzzle()
 
     def test_devices(self):
-        for puz in session.puzzlelist:
-            p = puzzle.Puzzle(puz.get("EduNetworkBuilder").get("Network"))
+        for entry in session.puzzlelist:
+            p = puzzle.Puzzle(puzzle.read_puzzle_data(entry["name"]))
             devs = p.devices
             for dev in devs:
                 self.assertIsInstance(dev, dict)
 
     def test_links(self):
-        for puz in session.puzzlelist:
-            p = puzzle.Puzzle(puz)
+        for entry in session.puzzlelist:
+            p = puzzle.Puzzle(puzzle.read_puzzle_data(entry["name"]))
             links = p.links
             for link in links:
                 self.assertIsInstance(link, dict)
@@ -101,6 +105,23 @@ class TestInit(unittest.TestCase):
         self.assertEqual(self.data, puzzle.Puzzle(self.data).json)
 
 
+class TestNormalize(unittest.TestCase):
+    def test_normalize_puzzle(self):
+        nic_data = {"nicname": "eth0", "interface": {"nicname": "eth0"}}
+        network = {
+            "device": {"hostname": "pc0", "nic": nic_data},
+            "link": [None],
+        }
+        puzzle.normalize_puzzle(network)
+        self.assertEqual([], network["link"])
+        self.assertEqual([], network["nettest"])
+        self.assertEqual([nic_data], network["device"][0]["nic"])
+        self.assertEqual([{"nicname": "eth0"}], nic_data["interface"])
+        self.assertEqual(["", ""], nic_data["nictype"])
+        self.assertEqual("", nic_data["encryptionkey"])
+        self.assertEqual("false", nic_data["usesdhcp"])
+
+
 class TestMatchesFilter(unittest.TestCase):
     def test_match(self):
         self.assertTrue(puzzle.matches_filter("crazylongname", r".*name.*"))
@@ -115,11 +136,91 @@ class TestMatchesFilter(unittest.TestCase):
         self.assertFalse(puzzle.matches_filter("crazylongname", r".*dhcp.*"))
 
 
+class TestCatalog(unittest.TestCase):
+    def test_catalog_is_current(self):
+        # Run scripts/update-puzzle-catalog.py if this fails.
+        self.assertEqual(
+            puzzle.read_json_file(str(puzzle.CATALOG_FILE)), puzzle.build_catalog()
+        )
+
+    def test_catalog_entry(self):
+        network = {"level": "2", "sortorder": "5", "en_title": "Demo", "tag": "VPN"}
+        self.assertEqual(
+            puzzle.catalog_entry("Level2_Demo", network),
+            {
+                "name": "Level2_Demo",
+                "level": "2",
+                "sortorder": "5",
+                "title": "Demo",
+                "tags": ["VPN"],
+            },
+        )
+
+    def test_choose_reads_selected_puzzle(self):
+        ui.CLI()
+        puz = puzzle.choosePuzzle("Level0_Ping")
+        self.assertEqual(puz["name"], "Level0_Ping")
+        self.assertIn("device", puz)
+        self.assertNotIn("device", session.puzzlelist[0])
+
+
+class TestPuzzleCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.saved_cache_dir = puzzle.PUZZLE_CACHE_DIR
+        puzzle.PUZZLE_CACHE_DIR = Path(self.cache_dir.name)
+        self.cache_path = puzzle.PUZZLE_CACHE_DIR / "Level0_Ping.marshal"
+
+    def tearDown(self):
+        puzzle.PUZZLE_CACHE_DIR = self.saved_cache_dir
+        self.cache_dir.cleanup()
+
+    def test_cache_written_and_reused(self):
+        parsed = puzzle.read_puzzle_data("Level0_Ping")
+        self.assertTrue(self.cache_path.is_file())
+        cached = puzzle.read_puzzle_data("Level0_Ping")
+        self.assertEqual(parsed, cached)
+        self.assertIsNot(parsed, cached)
+        self.assertIsInstance(cached["device"], list)
+
+    def test_stale_cache_rebuilt(self):
+        puzzle.write_cached_puzzle(self.cache_path, ("0", "stale"), {"name": "old"})
+        network = puzzle.read_puzzle_data("Level0_Ping")
+        self.assertEqual(network["name"], "Level0_Ping")
+        self.assertIn("device", network)
+        self.assertEqual(
+            puzzle.read_cached_puzzle(self.cache_path, ("0", "stale")), None
+        )
+
+    def test_normalizer_change_rebuilds(self):
+        source = (PUZZLES_DIR / "Level0_Ping.json").read_bytes()
+        key = (
+            puzzle.__version__,
+            puzzle.NORMALIZE_VERSION,
+            hashlib.sha256(source).hexdigest(),
+        )
+        puzzle.write_cached_puzzle(self.cache_path, key, {"name": "cached"})
+        self.assertEqual(puzzle.read_puzzle_data("Level0_Ping")["name"], "cached")
+        saved_version = puzzle.NORMALIZE_VERSION
+        puzzle.NORMALIZE_VERSION += 1
+        try:
+            network = puzzle.read_puzzle_data("Level0_Ping")
+        finally:
+            puzzle.NORMALIZE_VERSION = saved_version
+        self.assertEqual(network["name"], "Level0_Ping")
+
+    def test_corrupt_cache_ignored(self):
+        self.cache_path.write_bytes(b"")
+        with self.assertLogs(level="WARNING"):
+            network = puzzle.read_puzzle_data("Level0_Ping")
+        self.assertEqual(network["name"], "Level0_Ping")
+
+
 class TestFilterItems(unittest.TestCase):
     def setUp(self):
         self.puzzles = [
-            {"EduNetworkBuilder": {"Network": {"name": "puzzle1_dhcp"}}},
-            {"EduNetworkBuilder": {"Network": {"name": "puzzle2_vlan"}}},
+            {"name": "puzzle1_dhcp"},
+            {"name": "puzzle2_vlan"},
         ]
         self.puzzle_names = [
             "puzzle1_dhcp",
@@ -165,6 +266,35 @@ class TestPuzzleClass(unittest.TestCase):
     def test_deleteitem_success(self):
         self.assertTrue(session.puzzle.delete_item("pc1"))
 
+    def test_deleteitem_lookups(self):
+        link_name = session.puzzle.link_from_devices(
+            session.puzzle.device_from_name("pc1"),
+            session.puzzle.device_from_name("net_switch0"),
+        ).get("hostname")
+        session.puzzle.delete_item("pc1")
+        self.assertIsNone(session.puzzle.device_from_name("pc1"))
+        self.assertIsNone(session.puzzle.link_from_name(link_name))
+
+    def test_createitems_lookups(self):
+        session.puzzle.createDevice(["laptop", "100", "100"])
+        new_dev = session.puzzle.device_from_name("laptop0")
+        self.assertIsNotNone(new_dev)
+        self.assertEqual(
+            new_dev, session.puzzle.device_from_uid(new_dev.get("uniqueidentifier"))
+        )
+        for n in new_dev.get("nic"):
+            self.assertEqual(n, session.puzzle.nic_from_uid(n.get("uniqueidentifier")))
+        session.puzzle.createLink(["pc0", "net_switch0"])
+        self.assertIsNotNone(session.puzzle.link_from_name("pc0_link_net_switch0"))
+
+    def test_undo_lookups(self):
+        self.app.parser.parse("create device pc 100 100")
+        self.assertIsNotNone(session.puzzle.device_from_name("pc2"))
+        self.app.parser.parse("undo")
+        self.assertIsNone(session.puzzle.device_from_name("pc2"))
+        self.app.parser.parse("redo")
+        self.assertIsNotNone(session.puzzle.device_from_name("pc2"))
+
     def test_ispuzzledone_false(self):
         self.assertFalse(session.puzzle.is_solved())
 
@@ -244,6 +374,26 @@ class TestXFromY(unittest.TestCase):
     def test_linkfromname_notfound(self):
         self.assertIsNone(session.puzzle.link_from_name("no_such_link"))
 
+    def test_linkfromnicid_found(self):
+        for end in ("SrcNic", "DstNic"):
+            self.assertEqual(
+                self.link0,
+                session.puzzle.link_from_nic_id(self.link0.get(end).get("nicid")),
+            )
+
+    def test_linkfromnicid_notfound(self):
+        self.assertIsNone(session.puzzle.link_from_nic_id("999"))
+
+    def test_nicpeer_found(self):
+        src = self.link0.get("SrcNic")
+        dst = self.link0.get("DstNic")
+        peer_nic, peer_dev = session.puzzle.nic_peer(src.get("nicid"))
+        self.assertEqual(dst.get("nicid"), peer_nic.get("uniqueidentifier"))
+        self.assertEqual(dst.get("hostname"), peer_dev.get("hostname"))
+
+    def test_nicpeer_notfound(self):
+        self.assertIsNone(session.puzzle.nic_peer("999"))
+
     def test_nicfromid_found(self):
         self.assertEqual(
             self.nic00.get("uniqueidentifier"),
@@ -273,3 +423,170 @@ class TestProperties(unittest.TestCase):
                     elif n.name == "eth1":
                         self.assertFalse(n.is_connected())
                 break
+
+
+class TestArpIndex(unittest.TestCase):
+    def setUp(self):
+        self.puzzle_name = "Level0_HubVsSwitch"
+
+        # Load puzzle via app into session.puzzle.
+        self.app = ui.CLI()
+        self.app.load_puzzle(self.puzzle_name)  # sets session.puzzle
+        self.pc0 = device.Device("pc0")
+        self.eth0 = nic.Nic(self.pc0.nic_from_name("eth0"))
+
+    def test_arplookup_found(self):
+        ip = self.eth0.interfaces[0].ip
+        self.assertEqual(self.eth0.mac, session.puzzle.arp_lookup(ip))
+        self.assertEqual("pc0", session.puzzle.device_name_from_mac(self.eth0.mac))
+
+    def test_arplookup_empty(self):
+        self.assertIsNone(device.globalArpLookup("0.0.0.0"))
+
+    def test_arplookup_ipchanged(self):
+        old_ip = self.eth0.interfaces[0].ip
+        self.app.parser.parse("set pc0 eth0 10.9.9.9/24")
+        self.assertIsNone(session.puzzle.arp_lookup(old_ip))
+        self.assertEqual(self.eth0.mac, session.puzzle.arp_lookup("10.9.9.9"))
+        self.app.parser.parse("undo")
+        self.assertIsNone(session.puzzle.arp_lookup("10.9.9.9"))
+        self.assertIsNotNone(session.puzzle.arp_lookup(old_ip))
+
+
+class TestWireless(unittest.TestCase):
+    def setUp(self):
+        self.app = ui.CLI()
+        self.app.load_puzzle("Level5_WirelessAccessPoint")
+        self.laptop = device.Device("laptop1")
+        self.wlan = nic.Nic(self.laptop.nic_from_name("wlan2"))
+
+    def near_aps(self):
+        aps = session.puzzle.wireless_access_points_near(self.laptop, self.wlan)
+        return [d.get("hostname") for d, _ in aps]
+
+    def test_ap_key_mismatch(self):
+        self.assertEqual([], self.near_aps())
+        self.assertIsNone(self.wlan.get_connected_link())
+
+    def test_ap_key_changed(self):
+        self.app.parser.parse("set wap0 key myKey")
+        self.assertEqual(["wap0"], self.near_aps())
+        self.assertIsNotNone(self.wlan.get_connected_link())
+
+    def test_ap_out_of_range(self):
+        self.app.parser.parse("set wap0 key myKey")
+        self.app.parser.parse("set laptop1 pos 20 20")
+        self.assertEqual([], self.near_aps())
+        self.assertIsNone(self.wlan.get_connected_link())
+
+    def test_wireless_affected_client(self):
+        self.assertEqual({"laptop1"}, session.puzzle._wireless_affected({"laptop1"}))
+
+    def test_wireless_affected_ap(self):
+        self.app.parser.parse("set wap0 key myKey")
+        affected = session.puzzle._wireless_affected({"wap0"})
+        self.assertTrue({"wap0", "laptop1", "tablet0", "cellphone0"} <= affected)
+        self.assertNotIn("wrouter0", affected)
+
+    def test_wireless_affected_moved_client(self):
+        self.app.parser.parse("set laptop1 pos 20 20")
+        self.assertNotIn("laptop1", session.puzzle._wireless_affected({"wap0"}))
+
+    def test_wireless_dirty_cleared(self):
+        self.app.parser.parse("set laptop1 pos 20 20")
+        self.assertEqual(set(), session.puzzle._wireless_dirty)
+        session.puzzle.mark_wireless_dirty("laptop1")
+        self.assertEqual({"laptop1"}, session.puzzle._wireless_dirty)
+        session.puzzle.mark_wireless_dirty()
+        self.assertIsNone(session.puzzle._wireless_dirty)
+
+
+class TestBroadcastDomains(unittest.TestCase):
+    def setUp(self):
+        self.puzzle_name = "Level1_OneNetTwoSubnets"
+
+        # Load puzzle via app into session.puzzle.
+        self.app = ui.CLI()
+        self.app.load_puzzle(self.puzzle_name)  # sets session.puzzle
+
+    def nic_id(self, hostname, nicname="eth0"):
+        return nic.Nic(device.Device(hostname).nic_from_name(nicname)).uniqueidentifier
+
+    def test_same_domain(self):
+        self.assertTrue(
+            session.puzzle.same_broadcast_domain(self.nic_id("pc0"), self.nic_id("pc2"))
+        )
+        self.assertFalse(
+            session.puzzle.same_broadcast_domain(
+                self.nic_id("pc0"), self.nic_id("router0", "eth0")
+            )
+        )
+        self.assertIn(
+            self.nic_id("router1", "eth1"),
+            session.puzzle.broadcast_domain(self.nic_id("pc3")),
+        )
+
+    def test_power_off_switch(self):
+        self.app.parser.parse("set net_switch0 power off")
+        self.assertEqual(
+            frozenset({self.nic_id("pc0")}),
+            session.puzzle.broadcast_domain(self.nic_id("pc0")),
+        )
+        self.assertFalse(
+            session.puzzle.same_broadcast_domain(self.nic_id("pc0"), self.nic_id("pc1"))
+        )
+
+    def test_link_changes(self):
+        link_data = nic.Nic(
+            device.Device("pc0").nic_from_name("eth0")
+        ).get_connected_link()
+        session.puzzle.delete_item(link_data.get("hostname"))
+        self.assertFalse(
+            session.puzzle.same_broadcast_domain(self.nic_id("pc0"), self.nic_id("pc1"))
+        )
+        session.puzzle.createLink(["pc0", "net_switch0"])
+        self.assertTrue(
+            session.puzzle.same_broadcast_domain(self.nic_id("pc0"), self.nic_id("pc1"))
+        )
+
+
+class TestNetTests(unittest.TestCase):
+    def setUp(self):
+        ui.CLI().load_puzzle("Level0_PacketCorruption1")
+
+    def test_item_is_locked(self):
+        self.assertTrue(session.puzzle.item_is_locked("fluorescent0", "LockIP"))
+        self.assertFalse(session.puzzle.item_is_locked("fluorescent0", "LockLocation"))
+        self.assertTrue(session.puzzle.item_is_locked("router0", "LockLocation"))
+        self.assertFalse(session.puzzle.item_is_locked("router0", "LockIP", "eth0"))
+
+    def test_frozen_until_completed(self):
+        ui.CLI().load_puzzle("Level0_Frozen")
+        self.assertTrue(device.Device("net_switch0").frozen)
+        self.assertFalse(device.Device("pc0").frozen)
+        session.puzzle.mark_test_as_completed(
+            "pc0", "net_switch0", "DeviceIsFrozen", "thawed"
+        )
+        self.assertFalse(device.Device("net_switch0").frozen)
+        self.assertTrue(
+            session.puzzle.has_test_been_completed(
+                "net_switch0", "net_switch0", "DeviceIsFrozen"
+            )
+        )
+
+    def test_completion_tracking(self):
+        ui.CLI().load_puzzle("Level0_Frozen")
+        self.assertFalse(session.puzzle.is_solved())
+        session.puzzle.mark_test_as_completed(
+            "pc0", "laptop1", "SuccessfullyPings", "pinged"
+        )
+        self.assertFalse(session.puzzle.is_solved())
+        session.puzzle.mark_test_as_completed(
+            "net_switch0", "net_switch0", "DeviceIsFrozen", "thawed"
+        )
+        self.assertTrue(session.puzzle.is_solved())
+        tests = session.puzzle.take_unacknowledged_tests()
+        self.assertEqual(["pinged", "thawed"], [t["message"] for t in tests])
+        self.assertEqual([], session.puzzle.take_unacknowledged_tests())
+        session.puzzle.reopen_test(tests[0])
+        self.assertFalse(session.puzzle.is_solved())
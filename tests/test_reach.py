@@ -0,0 +1,81 @@
+import unittest
+
+from network_puzzles import reach, session, ui
+
+
+class TestReach(unittest.TestCase):
+    def trace(self, puzzle_name, src, dst):
+        app = ui.CLI()
+        app.load_puzzle(puzzle_name)
+        return reach.trace_ping(
+            app.puzzle.device_from_name(src), app.puzzle.device_from_name(dst)
+        )
+
+    def test_reachable(self):
+        result = self.trace("Level0_Ping", "pc0", "laptop1")
+        self.assertTrue(result.reachable)
+        self.assertEqual(
+            result.path,
+            ["net_switch0", "router0", "laptop1", "router0", "net_switch0", "pc0"],
+        )
+        self.assertEqual(result.hops, 3)
+        self.assertEqual(result.health, 100)
+
+    def test_broken_link(self):
+        result = self.trace("Level0_BrokenLink", "pc0", "laptop1")
+        self.assertFalse(result.reachable)
+        self.assertIn("router0_link_laptop1", result.reason)
+
+    def test_firewall(self):
+        result = self.trace("Level2_FirewallDemo", "pc0", "pc1")
+        self.assertFalse(result.reachable)
+        self.assertIn("firewall0", result.reason)
+
+    def test_tree_blocks_wireless(self):
+        result = self.trace("Level5_LineOfSight", "pc1", "server0")
+        self.assertFalse(result.reachable)
+        self.assertIn("tree", result.reason)
+
+    def test_frozen(self):
+        result = self.trace("Level0_Frozen", "pc0", "laptop1")
+        self.assertFalse(result.reachable)
+        self.assertIn("net_switch0 is frozen", result.reason)
+
+    def test_no_packets_or_undo(self):
+        app = ui.CLI()
+        app.load_puzzle("Level0_Ping")
+        undo_count = len(session.undolist)
+        self.assertTrue(app.parser.parse("reach pc0 laptop0"))
+        self.assertEqual(len(app.puzzle.packets), 0)
+        self.assertEqual(len(session.undolist), undo_count)
+
+    def test_matrix(self):
+        app = ui.CLI()
+        app.load_puzzle("Level1_OneNetTwoSubnets")
+        devices = reach.ip_devices()
+        matrix = reach.reach_matrix(devices)
+        self.assertEqual(len(matrix), len(devices) * (len(devices) - 1))
+        for (src, dst), result in matrix.items():
+            single = reach.trace_ping(
+                app.puzzle.device_from_name(src), app.puzzle.device_from_name(dst)
+            )
+            self.assertEqual(str(result), str(single))
+            self.assertEqual(result.hops, single.hops)
+        self.assertEqual(matrix[("pc0", "pc2")].hops, 4)
+
+    def test_broadcast(self):
+        app = ui.CLI()
+        app.load_puzzle("Level1_OneNetTwoSubnets")
+        pc0 = app.puzzle.device_from_name("pc0")
+        self.assertTrue(reach.trace_ping(pc0, "192.168.1.255").reachable)
+        result = reach.trace_ping(pc0, "192.168.5.255")
+        self.assertFalse(result.reachable)
+
+    def test_matrix_bad_netmask(self):
+        app = ui.CLI()
+        app.load_puzzle("Level1_BadNetmask")
+        app.parser.parse("reach all")
+        matrix = reach.reach_matrix()
+        result = matrix[("net_switch0", "router0")]
+        self.assertIsNone(result.reachable)
+        self.assertIn("net_switch0", result.reason)